@@ -0,0 +1,105 @@
+# Copyright (c) [2024] [Didier ALAIN]
+# Repository: https://github.com/Tanin69/AgriFieldGenerator
+#
+# The project makes it possible to generate patterns of large cultivated fields
+# reproducing as believable as possible the diversity of agricultural
+# landscapes. It allows you to generate texture masks that can be used in the
+# world editor of the Enfusion Workbench.
+#
+# It is released under
+# the MIT License. Please see the LICENSE file for details
+#
+# Enfusion is a game engine developed by Bohemia Interactive for the Arma game series
+# The Enfusion Workbench is a creation workbench dedicated to the Enfusion engine.
+#
+
+"""
+Checks that the startup of the command line stays fast.
+
+Measures the time to import the processing package and to run `run.py -h`,
+minus the startup time of the interpreter itself, and fails if it exceeds the
+budget. Also fails if importing the package imports one of the heavy libraries
+that only some processors need.
+
+`run.py -d main_polygon` is measured the same way, with the non-interactive
+Agg backend and its own budget, as it has to import matplotlib: it fails if it
+imports any other heavy library. It needs the configuration file and the saved
+main polygon, and is skipped without them.
+
+usage: python check_import_time.py [--budget SECONDS] [--display-budget SECONDS] [--runs N]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# Libraries that must only be imported by the processors that use them
+HEAVY_MODULES = ['matplotlib', 'scipy', 'networkx', 'rasterio', 'svg.path']
+
+COMMANDS = {
+    'import processing': [sys.executable, '-c', 'import processing; processing.Pipeline'],
+    'run.py -h': [sys.executable, 'run.py', '-h'],
+}
+
+# Displaying the main polygon needs matplotlib, but none of the other heavy libraries
+DISPLAY_COMMAND = [sys.executable, 'run.py', '-d', 'main_polygon']
+DISPLAY_MODULES = ['matplotlib']
+
+def _best_time(command, runs, env=None):
+    # The best of several runs is the least sensitive to the load of the machine
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, env=env)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time budget of the AgriFieldGenerator.')
+    parser.add_argument('--budget', type=float, default=0.2, help='Maximum startup time in seconds, on top of the interpreter startup (default is 0.2).')
+    parser.add_argument('--display-budget', type=float, default=1.0, help='Maximum time of run.py -d main_polygon in seconds, on top of the interpreter startup (default is 1.0).')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs of each command, the best one is kept (default is 5).')
+    args = parser.parse_args()
+
+    # Run from the directory of run.py, as run.py does
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    failed = False
+    loaded = subprocess.run([sys.executable, '-c', f'import sys, processing; processing.Pipeline; print(" ".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))'],
+                            check=True, capture_output=True, text=True).stdout.split()
+    if loaded:
+        print(f"FAIL  importing processing imports {', '.join(loaded)}")
+        failed = True
+
+    interpreter = _best_time([sys.executable, '-c', 'pass'], args.runs)
+    for name, command in COMMANDS.items():
+        elapsed = _best_time(command, args.runs) - interpreter
+        status = 'ok  ' if elapsed <= args.budget else 'FAIL'
+        failed = failed or elapsed > args.budget
+        print(f"{status}  {name:<24}{elapsed * 1000:8.0f} ms (budget {args.budget * 1000:.0f} ms)")
+
+    # The figure is rendered off screen, and the modules loaded by run.py are listed once it has run
+    env = dict(os.environ, MPLBACKEND='Agg')
+    name = ' '.join(DISPLAY_COMMAND[1:])
+    script = (f'import runpy, sys; sys.argv = {DISPLAY_COMMAND[1:]!r}; runpy.run_path("run.py", run_name="__main__"); '
+              f'print(" ".join(m for m in {HEAVY_MODULES!r} if m in sys.modules and m not in {DISPLAY_MODULES!r}))')
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        print(f"skip  {name:<24}needs the configuration file and the main polygon (run run.py -po first)")
+    else:
+        lines = result.stdout.splitlines()
+        loaded = lines[-1].split() if lines else []
+        if loaded:
+            print(f"FAIL  {name} imports {', '.join(loaded)}")
+            failed = True
+        elapsed = _best_time(DISPLAY_COMMAND, args.runs, env) - interpreter
+        status = 'ok  ' if elapsed <= args.display_budget else 'FAIL'
+        failed = failed or elapsed > args.display_budget
+        print(f"{status}  {name:<24}{elapsed * 1000:8.0f} ms (budget {args.display_budget * 1000:.0f} ms)")
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
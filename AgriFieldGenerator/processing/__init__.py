@@ -12,12 +12,35 @@
 # The Enfusion Workbench is a creation workbench dedicated to the Enfusion engine.
 # 
 
-from .data_processor_base_class import DataProcessorBaseClass
-from .mask_generator import MaskGenerator
-from .points_generator import PointsGenerator
-from .polyline_generator import PolylineGenerator
-from .voronoi_colorer import VoronoiColorer
-from .voronoi_filler import VoronoiFiller
-from .spline_to_svg import SplineToSVG
-from .svg_to_polygon import SVGToPolygon
+import importlib
 
+# The classes are imported on first access, so that importing the package does not import
+# the libraries of every processor (matplotlib, scipy, rasterio...) when only one is used.
+_exports = {
+    'DataProcessorBaseClass': 'data_processor_base_class',
+    'EnfusionUtils': 'enfusion_utils',
+    'GeometryStore': 'geometry_store',
+    'MaskGenerator': 'mask_generator',
+    'PointsGenerator': 'points_generator',
+    'Pipeline': 'pipeline',
+    'PolygonSimplifier': 'polygon_simplifier',
+    'PolylineGenerator': 'polyline_generator',
+    'VoronoiColorer': 'voronoi_colorer',
+    'VoronoiFiller': 'voronoi_filler',
+    'VoronoiTessellation': 'voronoi_tessellation',
+    'SplineToSVG': 'spline_to_svg',
+    'StageCache': 'stage_cache',
+    'SVGToPolygon': 'svg_to_polygon',
+}
+
+__all__ = list(_exports)
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{_exports[name]}', __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
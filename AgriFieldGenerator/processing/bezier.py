@@ -0,0 +1,108 @@
+# Copyright (c) [2024] [Didier ALAIN]
+# Repository: https://github.com/Tanin69/AgriFieldGenerator
+#
+# The project makes it possible to generate patterns of large cultivated fields
+# reproducing as believable as possible the diversity of agricultural
+# landscapes. It allows you to generate texture masks that can be used in the
+# world editor of the Enfusion Workbench.
+#
+# It is released under the MIT License. Please see the LICENSE file for details.
+#
+# Enfusion is a game engine developed by Bohemia Interactive for the Arma game series
+# The Enfusion Workbench is a creation workbench dedicated to the Enfusion engine.
+#
+
+"""
+Vectorized evaluation of Bezier curves.
+
+A Bezier curve of degree d is evaluated at n parameter values as the product of
+the (n, d + 1) Bernstein basis matrix and its (d + 1, 2) control points, so a
+batch of curves of the same degree and sample count is evaluated in a single
+NumPy operation.
+"""
+
+from functools import lru_cache
+import math
+
+import numpy as np
+
+@lru_cache(maxsize=None)
+def bernstein_basis(degree, num_samples):
+    """
+    Computes the Bernstein basis matrix of a given degree, at evenly spaced parameter values.
+
+    Parameters
+    ----------
+    degree : int
+        The degree of the curves.
+    num_samples : int
+        The number of parameter values, from 0 to 1 included.
+
+    Returns
+    -------
+    numpy.ndarray
+        The read-only (num_samples, degree + 1) matrix. Its first and last rows are exactly
+        (1, 0, ..., 0) and (0, ..., 0, 1), so the curves start and end exactly on their end points.
+    """
+    t = np.linspace(0.0, 1.0, num_samples)[:, None]
+    k = np.arange(degree + 1)
+    binomials = np.array([math.comb(degree, i) for i in k], dtype=np.float64)
+    basis = binomials * t ** k * (1.0 - t) ** (degree - k)
+    basis.flags.writeable = False
+    return basis
+
+def evaluate_bezier(control_points, num_samples):
+    """
+    Evaluates a batch of Bezier curves of the same degree.
+
+    Parameters
+    ----------
+    control_points : numpy.ndarray
+        The (..., degree + 1, dims) array of the control points of the curves.
+    num_samples : int
+        The number of points to compute on each curve.
+
+    Returns
+    -------
+    numpy.ndarray
+        The (..., num_samples, dims) array of the points of the curves.
+    """
+    control_points = np.asarray(control_points, dtype=np.float64)
+    basis = bernstein_basis(control_points.shape[-2] - 1, num_samples)
+    return np.einsum('sk,...kd->...sd', basis, control_points)
+
+def flatten_cubic_bezier(control_points, tolerance):
+    """
+    Flattens a batch of cubic Bezier curves into polylines, with a number of points per curve chosen from a
+    chordal error tolerance.
+
+    The distance between a cubic curve and its polyline of n equal parameter steps is at most
+    0.75 * M / n ** 2, where M is the largest second difference of its control points, so n is
+    ceil(sqrt(0.75 * M / tolerance)). Curves with the same number of steps are evaluated together.
+
+    Parameters
+    ----------
+    control_points : numpy.ndarray
+        The (S, 4, 2) array of the control points of the curves.
+    tolerance : float
+        The maximum distance between a curve and its polyline. It must be greater than 0.
+
+    Returns
+    -------
+    tuple
+        The (P, 2) array of the points of all the polylines, one after the other, and the (S,) array of their
+        number of points. The points of a polyline exclude the start point of its curve and include its end
+        point, so that the polylines of consecutive curves can be chained.
+    """
+    control_points = np.asarray(control_points, dtype=np.float64).reshape(-1, 4, 2)
+    second_differences = np.maximum(np.linalg.norm(control_points[:, 0] - 2 * control_points[:, 1] + control_points[:, 2], axis=1),
+                                    np.linalg.norm(control_points[:, 1] - 2 * control_points[:, 2] + control_points[:, 3], axis=1))
+    steps = np.maximum(np.ceil(np.sqrt(0.75 * second_differences / tolerance)), 1).astype(np.int64)
+
+    offsets = np.concatenate([[0], np.cumsum(steps)])
+    points = np.empty((offsets[-1], 2))
+    for num_steps in np.unique(steps).tolist():
+        curves = np.flatnonzero(steps == num_steps)
+        curve_points = evaluate_bezier(control_points[curves], num_steps + 1)[:, 1:]
+        points[(offsets[curves][:, None] + np.arange(num_steps)).ravel()] = curve_points.reshape(-1, 2)
+    return points, steps
@@ -13,14 +13,15 @@
 # 
 
 import os
+import sys
 
-import matplotlib.figure
-import matplotlib.patches as patches
-import matplotlib.pyplot as plt
+import numpy as np
 import pickle
 from PIL import Image
 from shapely.geometry import MultiPolygon, Polygon
 
+from .geometry_store import GeometryStore
+
 # Increase the maximum image pixels limit beacause Enfusion image files are very large
 Image.MAX_IMAGE_PIXELS = 400000000
 
@@ -29,13 +30,23 @@ class DataProcessorBaseClass:
     Base class for data processing tasks. Provides methods for loading and saving data, 
     and a method for processing data that should be implemented by subclasses.
     """
-    def __init__(self, source_path, save_path, save_data_path, svg_path, svg_height, svg_width):
+    # The number of items drawn by each chunk generator (see chunk_generators)
+    RNG_CHUNK_SIZE = 4096
+
+    def __init__(self, source_path, save_path, save_data_path, svg_path, svg_height, svg_width, artifact_format='columnar', checkpoint=True, seed=None):
         """
         Initializes a new instance of the class. Sets the source, save, and save data directories.
 
         :param source_path: The path to the source directory where the input data is located.
         :param save_path: The path to the directory where the processed data should be saved.
         :param save_data_path: The path to the directory where any additional data should be saved.
+        :param artifact_format: The format of the geometry artifacts saved by the processor, 'columnar' or 'pickle' 
+            (default is 'columnar'). See `GeometryStore`.
+        :param checkpoint: Whether the points and geometries are written to the save data directory (default is True).
+            When False, they are only kept in memory and any outdated file is removed, so that it cannot be loaded
+            by mistake later.
+        :param seed: The seed of the random generator of the processor: an int, a numpy SeedSequence, or None
+            (default) for a different result at each run. The pipeline passes a child SeedSequence per stage.
         """
         self.source_directory = source_path
         self.save_directory = save_path
@@ -43,6 +54,11 @@ class DataProcessorBaseClass:
         self.svg_path = svg_path
         self.svg_height = svg_height
         self.svg_width = svg_width
+        self.artifact_format = artifact_format
+        self.checkpoint = checkpoint
+        self.geometry_store = GeometryStore(save_data_path)
+        self.seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.rng = np.random.default_rng(self.seed_sequence)
         self.points = None
         self.polygon = None
         self.polygons = None
@@ -52,17 +68,37 @@ class DataProcessorBaseClass:
         This method should be implemented by subclasses. It should contain the logic for processing the data.
         """
         raise NotImplementedError("Subclasses should implement this!")
-    
+
+    def chunk_generators(self, num_items, chunk_size=None):
+        """
+        Creates one random generator per chunk of items, for the work that is split into chunks.
+        The generator of a chunk only depends on the seed and on the index of the chunk, and the
+        chunks have a fixed size, so that the result does not depend on the number of workers nor
+        on the order in which the chunks are processed.
+
+        :param num_items: The number of items.
+        :param chunk_size: The number of items of each chunk (default is RNG_CHUNK_SIZE).
+        :return: The list of the (start, stop, generator) tuples of the chunks.
+        """
+        chunk_size = chunk_size or self.RNG_CHUNK_SIZE
+        entropy, spawn_key = self.seed_sequence.entropy, self.seed_sequence.spawn_key
+        return [(start, min(start + chunk_size, num_items),
+                 np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=spawn_key + (index,))))
+                for index, start in enumerate(range(0, num_items, chunk_size))]
+
     def load(self, filename, data_file=False):
         """
-        Loads a file from the save data directory. If `data_file` is `True`, the file is loaded using `pickle`. 
-        Otherwise, the file is loaded as an image.
+        Loads a file from the save data directory. If `data_file` is `True`, the file is loaded using `pickle`, 
+        or memory-mapped with `numpy` if it is a `.npy` file. Otherwise, the file is loaded as an image.
 
         :param filename: The name of the file to load.
         :param data_file: A boolean indicating whether the file is a data file (default is False).
         :return: The loaded file.
         """
-        if data_file:
+        if data_file and filename.endswith('.npy'):
+            load_path = self.save_data_directory + filename
+            loaded_file = np.load(load_path, mmap_mode='r')
+        elif data_file:
             load_path = self.save_data_directory + filename
             loaded_file = pickle.load(open(load_path, 'rb'))
         else:
@@ -73,7 +109,8 @@ class DataProcessorBaseClass:
     def save(self, result, filename, data_file=False, dpi=100):
         """
         Saves a file to the save directory or the save data directory, depending on the value of `data_file`. 
-        If `data_file` is `True`, the file is saved using `pickle`. Otherwise, the file is saved as an image. 
+        If `data_file` is `True`, the file is saved using `pickle`, or with `numpy` as a float64 array if it is 
+        a `.npy` file. Otherwise, the file is saved as an image. 
         If the result is a `matplotlib.figure.Figure`, it is saved with the specified DPI.
 
         :param result: The result to save.
@@ -84,25 +121,111 @@ class DataProcessorBaseClass:
         if data_file:
             if not os.path.exists(self.save_data_directory):
                 os.makedirs(self.save_data_directory)
+            if filename.endswith('.npy'):
+                np.save(self.save_data_directory + filename, np.ascontiguousarray(result, dtype=np.float64))
+                return
             with open(self.save_data_directory + filename, 'wb') as f:
                 pickle.dump(result, f)
         else:
             if not os.path.exists(self.save_directory):
                 os.makedirs(self.save_directory)
+            if isinstance(result, Image.Image):
+                result.save(self.save_directory + filename, 'PNG')
+                return
+            # matplotlib is already imported if the result is a figure
+            import matplotlib.figure
             if isinstance(result, matplotlib.figure.Figure):
                 result.savefig(self.save_directory + filename, format='png', dpi=dpi)
-            elif isinstance(result, Image.Image):
-                result.save(self.save_directory + filename, 'PNG')
             else:
                 raise TypeError(f"Unable to save object of type {type(result)}")
 
+    def load_points(self):
+        """
+        Loads the seed points. They are memory-mapped from 'points.npy', so that loading does not copy them. 
+        A 'points.pkl' file written by a previous version is still accepted.
+
+        :return: A (N, 2) float64 array of points.
+        """
+        try:
+            return self.load('points.npy', data_file=True)
+        except FileNotFoundError:
+            points = self.load('points.pkl', data_file=True)
+            return np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+    def save_points(self, points):
+        """
+        Saves the seed points to 'points.npy' as a contiguous (N, 2) float64 array, and removes any outdated 
+        'points.pkl' file.
+
+        :param points: The points to save.
+        """
+        if self.checkpoint:
+            self.save(np.asarray(points, dtype=np.float64).reshape(-1, 2), 'points.npy', data_file=True)
+        elif os.path.exists(self.save_data_directory + 'points.npy'):
+            os.remove(self.save_data_directory + 'points.npy')
+        if os.path.exists(self.save_data_directory + 'points.pkl'):
+            os.remove(self.save_data_directory + 'points.pkl')
+
+    def load_adjacency(self):
+        """
+        Loads the adjacency list of the Voronoi polygons from 'adjacency.pkl'.
+
+        :return: The list of the sorted indices of the neighbours of each polygon.
+        """
+        return self.load('adjacency.pkl', data_file=True)
+
+    def save_adjacency(self, adjacency):
+        """
+        Saves the adjacency list of the Voronoi polygons to 'adjacency.pkl'. Without checkpoint, the outdated
+        file is removed instead.
+
+        :param adjacency: The list of the sorted indices of the neighbours of each polygon.
+        """
+        if self.checkpoint:
+            self.save(adjacency, 'adjacency.pkl', data_file=True)
+        elif os.path.exists(self.save_data_directory + 'adjacency.pkl'):
+            os.remove(self.save_data_directory + 'adjacency.pkl')
+
+    def load_geometries(self, name, bbox=None):
+        """
+        Loads a geometry artifact ('polygon', 'voronoi' or 'colored'), in whichever format it was saved.
+
+        :param name: The name of the artifact.
+        :param bbox: An optional (minx, miny, maxx, maxy) bounding box. If given, only the geometries 
+            intersecting it are loaded.
+        :return: The loaded geometries.
+        """
+        return self.geometry_store.load(name, bbox=bbox)
+
+    def save_geometries(self, result, name, meta=None):
+        """
+        Saves a geometry artifact ('polygon', 'voronoi' or 'colored') in the format of the processor. 
+        Without checkpoint, the outdated artifact is removed instead.
+
+        :param result: The geometries to save.
+        :param name: The name of the artifact.
+        :param meta: Additional metadata of the artifact (see `GeometryStore.save`).
+        """
+        if self.checkpoint:
+            self.geometry_store.save(result, name, artifact_format=self.artifact_format, meta=meta)
+        else:
+            self.geometry_store.remove(name)
+
+    def remove_geometries(self, name):
+        """
+        Removes a geometry artifact, whatever its format.
+
+        :param name: The name of the artifact.
+        """
+        self.geometry_store.remove(name)
+
     def display(self, file_to_display):
         """
        
 
         """
         try:
-            self.polygon = self.load('polygon.pkl', data_file=True)
+            self.polygon = self.load_geometries('polygon')
         except FileNotFoundError:
             raise FileNotFoundError("Polygon data are missing. Please run the relevant generator(s) first.")
 
@@ -112,7 +235,7 @@ class DataProcessorBaseClass:
 
         if file_to_display == 'seed_points':
             try:
-                self.points = self.load('points.pkl', data_file=True)
+                self.points = self.load_points()
             except FileNotFoundError:
                 raise FileNotFoundError("Main polygon or seed points data are missing. Please run the relevant generator(s) first.")
             self._plot(points=True, bounding_box=True)
@@ -120,14 +243,36 @@ class DataProcessorBaseClass:
 
         if file_to_display == 'voronoi':
             try:
-                self.polygons = self.load('voronoi.pkl', data_file=True)
+                self.polygons = self.load_geometries('voronoi')
             except FileNotFoundError:
                 raise FileNotFoundError("Voronoi diagram data are missing. Please run the relevant generator(s) first.")
             self._plot(polygons=True)
             return
 
+    def _pyplot(self, interactive=False):
+        """
+        Imports `matplotlib.pyplot` when a plot is first needed, as matplotlib is slow to import. Unless the plot 
+        is going to be shown, or a backend is set with the MPLBACKEND environment variable, the non-interactive 
+        Agg backend is selected, which avoids starting a GUI toolkit to render images.
+
+        :param interactive: Whether the plot is going to be shown (default is False).
+        :return: The `matplotlib.pyplot` module.
+        """
+        import matplotlib
+        if 'MPLBACKEND' not in os.environ:
+            if not interactive and 'matplotlib.pyplot' not in sys.modules:
+                matplotlib.use('Agg')
+            elif interactive and 'matplotlib.pyplot' in sys.modules and matplotlib.get_backend().lower() == 'agg':
+                # Agg was selected for a previous plot: get back to the default backend to show this one
+                import matplotlib.pyplot as plt
+                plt.switch_backend(matplotlib.rcParamsOrig['backend'])
+        import matplotlib.pyplot as plt
+        return plt
+
     def _plot(self, points=False, bounding_box=False, polygons=False):
-        
+        import matplotlib.patches as patches
+        plt = self._pyplot(interactive=True)
+
         # Create a new figure and axes
         fig, ax = plt.subplots()
         
@@ -152,8 +297,7 @@ class DataProcessorBaseClass:
         
         if points:    
             # Display points
-            for point in self.points:
-                ax.plot(*point, 'ko', markersize=1)
+            ax.plot(self.points[:, 0], self.points[:, 1], 'ko', markersize=1)
 
         if polygons:
             for polygon in self.polygons:
@@ -0,0 +1,183 @@
+# Copyright (c) [2024] [Didier ALAIN]
+# Repository: https://github.com/Tanin69/AgriFieldGenerator
+# 
+# The project makes it possible to generate patterns of large cultivated fields 
+# reproducing as believable as possible the diversity of agricultural 
+# landscapes. It allows you to generate texture masks that can be used in the
+# world editor of the Enfusion Workbench.
+#
+# It is released under the MIT License. Please see the LICENSE file for details.
+#
+# Enfusion is a game engine developed by Bohemia Interactive for the Arma game series
+# The Enfusion Workbench is a creation workbench dedicated to the Enfusion engine.
+# 
+
+import math
+import warnings
+
+import numpy as np
+import shapely
+
+class EnfusionUtils:
+    """
+    A class gathering helpers related to the Enfusion terrain, such as finding
+    the terrain tiles affected by geometries or masks.
+
+    Tiles are numbered row by row from the bottom left corner of the map, in SVG
+    coordinates (y axis pointing up): index = tile_y * num_x_tiles + tile_x.
+
+    Attributes
+    ----------
+    svg_height : int
+        The height of the SVG.
+    svg_width : int
+        The width of the SVG.
+    tile_size : int
+        The size of the tiles.
+    num_x_tiles : int
+        The number of tiles in a row, used to compute tile indices.
+
+    Methods
+    -------
+    get_tile_index(x, y)
+        Gets the tile index for a given point.
+    get_geometry_tiles(geometries)
+        Gets the indices of the tiles intersected by geometries.
+    get_mask_tiles(mask)
+        Gets the indices of the tiles containing non-zero pixels of a mask.
+    """
+    def __init__(self, svg_height, svg_width, tile_size):
+        self.svg_height = svg_height
+        self.svg_width = svg_width
+        self.tile_size = tile_size
+        self.num_x_tiles = round(self.svg_width / self.tile_size)
+        self._tile_boxes = None
+
+    def get_tile_index(self, x, y):
+        """
+        Gets the tile index for a given point.
+
+        Parameters
+        ----------
+        x : int
+            The x-coordinate of the point.
+        y : int
+            The y-coordinate of the point.
+
+        Returns
+        -------
+        int
+            The tile index.
+        """
+        tile_x = x // self.tile_size
+        tile_y = y // self.tile_size
+        tile_index = int(tile_y * self.num_x_tiles + tile_x)
+        return tile_index
+
+    def get_geometry_tiles(self, geometries):
+        """
+        Gets the indices of the tiles whose interior is intersected by geometries.
+
+        All the geometries are queried at once against a STRtree of the tile
+        grid, so the result is exact, whatever the size of the geometries.
+
+        Parameters
+        ----------
+        geometries : shapely.Geometry or list
+            A geometry (e.g. the main MultiPolygon) or a list of geometries (e.g.
+            the polygons of colored.pkl).
+
+        Returns
+        -------
+        list
+            The sorted list of tile indices.
+        """
+        geometries = np.atleast_1d(np.asarray(geometries, dtype=object))
+        tile_indices, tiles = self._tile_grid()
+        tree = shapely.STRtree(tiles)
+        geometry_ids, tile_ids = tree.query(geometries, predicate='intersects')
+
+        # A geometry that only touches the border of a tile does not change it
+        inside = ~shapely.touches(geometries[geometry_ids], tiles[tile_ids])
+        return np.unique(tile_indices[tile_ids[inside]]).tolist()
+
+    def get_mask_tiles(self, mask):
+        """
+        Gets the indices of the tiles that contain non-zero pixels of a mask.
+
+        Parameters
+        ----------
+        mask : numpy.ndarray or str
+            A (svg_height, svg_width) array, or the path to a mask image (e.g.
+            a merged mask), which is then read by bands of tile rows.
+
+        Returns
+        -------
+        list
+            The sorted list of tile indices.
+        """
+        if not isinstance(mask, str):
+            return np.unique(self._mask_block_tiles(np.asarray(mask), 0)).tolist()
+
+        # rasterio is only needed to read mask images, and is slow to import
+        import rasterio
+        from rasterio.errors import NotGeoreferencedWarning
+        from rasterio.windows import Window
+
+        tile_indices = []
+        with warnings.catch_warnings():
+            # PNG masks have no georeferencing, which is expected here
+            warnings.simplefilter('ignore', NotGeoreferencedWarning)
+            source = rasterio.open(mask)
+        with source:
+            for row in range(0, source.height, self.tile_size):
+                height = min(self.tile_size, source.height - row)
+                block = source.read(1, window=Window(0, row, source.width, height))
+                tile_indices.append(self._mask_block_tiles(block, row))
+        return np.unique(np.concatenate(tile_indices)).tolist()
+
+    def _mask_block_tiles(self, block, row):
+        """
+        Gets the indices of the tiles that contain non-zero pixels of a block of
+        mask rows.
+
+        Parameters
+        ----------
+        block : numpy.ndarray
+            A (rows, svg_width) array of mask rows.
+        row : int
+            The first row of the block, from the top of the map.
+
+        Returns
+        -------
+        numpy.ndarray
+            The tile indices, possibly with duplicates.
+        """
+        # Image rows start at the top, tile rows at the bottom of the map
+        rows = np.arange(row, row + block.shape[0])
+        tile_y = np.floor((self.svg_height - rows - 0.5) / self.tile_size).astype(int)
+        row_starts = np.flatnonzero(np.r_[True, np.diff(tile_y) != 0])
+        col_starts = np.arange(0, block.shape[1], self.tile_size)
+
+        # Maximum of the pixels of each tile
+        hits = np.maximum.reduceat(np.maximum.reduceat(block, row_starts, axis=0), col_starts, axis=1)
+        hit_y, hit_x = np.nonzero(hits)
+        return tile_y[row_starts][hit_y] * self.num_x_tiles + hit_x
+
+    def _tile_grid(self):
+        """
+        Builds the boxes of the tiles covering the map.
+
+        Returns
+        -------
+        tuple
+            The array of tile indices and the array of the matching tile boxes.
+        """
+        if self._tile_boxes is None:
+            tile_x, tile_y = np.meshgrid(np.arange(math.ceil(self.svg_width / self.tile_size)),
+                                         np.arange(math.ceil(self.svg_height / self.tile_size)))
+            tile_x, tile_y = tile_x.ravel(), tile_y.ravel()
+            boxes = shapely.box(tile_x * self.tile_size, tile_y * self.tile_size,
+                                (tile_x + 1) * self.tile_size, (tile_y + 1) * self.tile_size)
+            self._tile_boxes = (tile_y * self.num_x_tiles + tile_x, boxes)
+        return self._tile_boxes
@@ -0,0 +1,323 @@
+# Copyright (c) [2024] [Didier ALAIN]
+# Repository: https://github.com/Tanin69/AgriFieldGenerator
+#
+# The project makes it possible to generate patterns of large cultivated fields
+# reproducing as believable as possible the diversity of agricultural
+# landscapes. It allows you to generate texture masks that can be used in the
+# world editor of the Enfusion Workbench.
+#
+# It is released under the MIT License. Please see the LICENSE file for details.
+#
+# Enfusion is a game engine developed by Bohemia Interactive for the Arma game series
+# The Enfusion Workbench is a creation workbench dedicated to the Enfusion engine.
+#
+
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+import shapely
+from shapely.geometry import MultiPolygon, Polygon
+
+class GeometryStore:
+    """
+    A class used to save and load the geometry artifacts of the pipeline: the
+    main polygon ('polygon'), the Voronoi polygons ('voronoi') and the colored
+    polygons ('colored').
+
+    Two formats are supported:
+
+    - 'pickle': the Python objects are pickled to '<name>.pkl'.
+    - 'columnar': the geometries are stored in a '<name>.columnar' directory of
+      NumPy arrays: the WKB of all the geometries concatenated in one uint8
+      array, their offsets, their bounds, and one array per attribute (color
+      index, border width). Arrays are memory-mapped when loaded, and a
+      bounding box can be given to decode only the geometries that intersect it.
+      WKB does not depend on the shapely version.
+
+    Saving in one format removes the artifact saved in the other one, and
+    loading uses whichever exists, so pickle files remain readable.
+
+    Attributes
+    ----------
+    directory : str
+        The directory where the artifacts are stored.
+
+    Methods
+    -------
+    save(result, name, artifact_format='columnar', meta=None)
+        Saves a geometry artifact.
+    load(name, bbox=None)
+        Loads a geometry artifact.
+    load_meta(name)
+        Loads the metadata of a geometry artifact.
+    remove(name)
+        Removes a geometry artifact, whatever its format.
+    path(name, artifact_format=None)
+        Gets the path of a geometry artifact.
+    """
+    FORMATS = ('pickle', 'columnar')
+    VERSION = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def save(self, result, name, artifact_format='columnar', meta=None):
+        """
+        Saves a geometry artifact.
+
+        Parameters
+        ----------
+        result : shapely.Geometry or list
+            A (Multi)Polygon, a list of geometries or a list of ColoredPolygon
+            objects.
+        name : str
+            The name of the artifact, e.g. 'voronoi'.
+        artifact_format : str, optional
+            'columnar' or 'pickle' (default is 'columnar').
+        meta : dict, optional
+            Additional metadata, e.g. statistics of the processor, written to
+            the meta.json file of a columnar artifact, or to a '<name>.meta.json'
+            file next to a pickled artifact.
+        """
+        if artifact_format not in self.FORMATS:
+            raise ValueError(f"Unknown artifact format: {artifact_format}. Choose 'columnar' or 'pickle'.")
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        if artifact_format == 'pickle':
+            with open(self._pickle_path(name), 'wb') as f:
+                pickle.dump(result, f)
+            self._remove_columnar(name)
+            # A pickled artifact has no metadata of its own: the additional metadata is kept next to it
+            if meta:
+                with open(self._meta_path(name), 'w') as f:
+                    json.dump(meta, f)
+            elif os.path.exists(self._meta_path(name)):
+                os.remove(self._meta_path(name))
+            return
+
+        geometries, columns, artifact_meta = self._to_columns(result)
+        self._write_columnar(name, geometries, columns, dict(meta or {}, **artifact_meta))
+        for path in (self._pickle_path(name), self._meta_path(name)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def load(self, name, bbox=None):
+        """
+        Loads a geometry artifact.
+
+        Parameters
+        ----------
+        name : str
+            The name of the artifact, e.g. 'voronoi'.
+        bbox : tuple, optional
+            A (minx, miny, maxx, maxy) bounding box. If given, only the
+            geometries (or the polygons of the main MultiPolygon) whose bounds
+            intersect it are loaded.
+
+        Returns
+        -------
+        shapely.Geometry or list
+            The same kind of object as the one that was saved.
+
+        Raises
+        ------
+        FileNotFoundError
+            If the artifact does not exist in any format.
+        """
+        if os.path.isdir(self._columnar_path(name)):
+            return self._read_columnar(name, bbox)
+
+        with open(self._pickle_path(name), 'rb') as f:
+            result = pickle.load(f)
+        if bbox is None:
+            return result
+        if isinstance(result, Polygon):
+            return result if self._in_bbox(shapely.bounds(result), bbox)[0] else Polygon()
+        if isinstance(result, MultiPolygon):
+            parts = shapely.get_parts(result)
+            return MultiPolygon(list(parts[self._in_bbox(shapely.bounds(parts), bbox)]))
+        geometries = [getattr(item, 'polygon', item) for item in result]
+        selected = self._in_bbox(shapely.bounds(geometries), bbox)
+        return [item for item, keep in zip(result, selected) if keep]
+
+    def load_meta(self, name):
+        """
+        Loads the metadata of a geometry artifact, including the additional
+        metadata given to save.
+
+        Parameters
+        ----------
+        name : str
+            The name of the artifact, e.g. 'polygon'.
+
+        Returns
+        -------
+        dict
+            The content of the meta.json file of a columnar artifact. For a
+            pickled artifact, the additional metadata given to save, if any.
+
+        Raises
+        ------
+        FileNotFoundError
+            If the artifact does not exist in any format.
+        """
+        if os.path.isdir(self._columnar_path(name)):
+            with open(os.path.join(self._columnar_path(name), 'meta.json')) as f:
+                return json.load(f)
+        if not os.path.exists(self._pickle_path(name)):
+            raise FileNotFoundError(f"No {name} artifact in {self.directory}")
+        if os.path.exists(self._meta_path(name)):
+            with open(self._meta_path(name)) as f:
+                return json.load(f)
+        return {}
+
+    def remove(self, name):
+        """
+        Removes a geometry artifact, whatever its format.
+
+        Parameters
+        ----------
+        name : str
+            The name of the artifact, e.g. 'voronoi'.
+        """
+        for path in (self._pickle_path(name), self._meta_path(name)):
+            if os.path.exists(path):
+                os.remove(path)
+        self._remove_columnar(name)
+
+    def path(self, name, artifact_format=None):
+        """
+        Gets the path of a geometry artifact.
+
+        Parameters
+        ----------
+        name : str
+            The name of the artifact, e.g. 'voronoi'.
+        artifact_format : str, optional
+            If given, the path the artifact has in this format, whether it exists
+            or not. Otherwise, the path of the existing artifact.
+
+        Returns
+        -------
+        str
+            The path of the '.columnar' directory or of the '.pkl' file, None if
+            no format is given and the artifact does not exist.
+        """
+        if artifact_format == 'columnar':
+            return self._columnar_path(name)
+        if artifact_format == 'pickle':
+            return self._pickle_path(name)
+        for path in (self._columnar_path(name), self._pickle_path(name)):
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _to_columns(self, result):
+        """
+        Splits an artifact into an array of geometries, attribute columns and
+        metadata.
+        """
+        # Import here: voronoi_colorer imports the base class, which imports this module
+        from .voronoi_colorer import ColoredPolygon
+
+        if isinstance(result, Polygon):
+            return np.array([result], dtype=object), {}, {'kind': 'polygon'}
+        if isinstance(result, MultiPolygon):
+            return shapely.get_parts(result), {}, {'kind': 'multipolygon'}
+
+        result = list(result)
+        if result and all(isinstance(item, ColoredPolygon) for item in result):
+            colors = list(dict.fromkeys(item.color for item in result))
+            columns = {
+                'color_index': np.array([colors.index(item.color) for item in result], dtype=np.int16),
+                'border_width': np.array([np.nan if item.border_width is None else item.border_width for item in result], dtype=np.float64),
+            }
+            geometries = np.empty(len(result), dtype=object)
+            geometries[:] = [item.polygon for item in result]
+            return geometries, columns, {'kind': 'colored', 'colors': colors}
+
+        geometries = np.empty(len(result), dtype=object)
+        geometries[:] = result
+        return geometries, {}, {'kind': 'list'}
+
+    def _write_columnar(self, name, geometries, columns, meta):
+        """
+        Writes the arrays of a columnar artifact. They are written to a temporary
+        directory first, so that an interrupted save never leaves a partial artifact.
+        """
+        path = self._columnar_path(name)
+        temporary_path = path + '.tmp'
+        if os.path.exists(temporary_path):
+            shutil.rmtree(temporary_path)
+        os.makedirs(temporary_path)
+
+        wkb = shapely.to_wkb(geometries)
+        lengths = np.fromiter((len(item) for item in wkb), dtype=np.int64, count=len(wkb))
+        offsets = np.zeros(len(wkb) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        np.save(os.path.join(temporary_path, 'wkb.npy'), np.frombuffer(b''.join(wkb), dtype=np.uint8))
+        np.save(os.path.join(temporary_path, 'offsets.npy'), offsets)
+        np.save(os.path.join(temporary_path, 'bounds.npy'), shapely.bounds(geometries).reshape(-1, 4))
+        for column, values in columns.items():
+            np.save(os.path.join(temporary_path, f'column_{column}.npy'), values)
+
+        meta = dict(meta, version=self.VERSION, count=len(geometries), columns=list(columns))
+        with open(os.path.join(temporary_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        self._remove_columnar(name)
+        os.rename(temporary_path, path)
+
+    def _read_columnar(self, name, bbox=None):
+        """
+        Reads a columnar artifact, memory-mapping its arrays, and rebuilds the
+        saved object.
+        """
+        from .voronoi_colorer import ColoredPolygon
+
+        path = self._columnar_path(name)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        wkb = np.load(os.path.join(path, 'wkb.npy'), mmap_mode='r')
+        offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+
+        indices = np.arange(meta['count'])
+        if bbox is not None:
+            bounds = np.load(os.path.join(path, 'bounds.npy'), mmap_mode='r')
+            indices = indices[self._in_bbox(bounds, bbox)]
+
+        # Only the bytes of the selected geometries are read from the memory map
+        geometries = shapely.from_wkb([wkb[offsets[i]:offsets[i + 1]].tobytes() for i in indices])
+        columns = {column: np.load(os.path.join(path, f'column_{column}.npy'), mmap_mode='r')[indices] for column in meta['columns']}
+
+        if meta['kind'] == 'polygon':
+            return geometries[0] if len(geometries) else Polygon()
+        if meta['kind'] == 'multipolygon':
+            return MultiPolygon(list(geometries))
+        if meta['kind'] == 'colored':
+            colors = meta['colors']
+            return [ColoredPolygon(geometry, color=colors[color_index], border_width=None if np.isnan(border_width) else float(border_width))
+                    for geometry, color_index, border_width in zip(geometries, columns['color_index'], columns['border_width'])]
+        return list(geometries)
+
+    def _remove_columnar(self, name):
+        if os.path.isdir(self._columnar_path(name)):
+            shutil.rmtree(self._columnar_path(name))
+
+    def _in_bbox(self, bounds, bbox):
+        minx, miny, maxx, maxy = bbox
+        bounds = np.asarray(bounds).reshape(-1, 4)
+        return (bounds[:, 0] <= maxx) & (bounds[:, 2] >= minx) & (bounds[:, 1] <= maxy) & (bounds[:, 3] >= miny)
+
+    def _pickle_path(self, name):
+        return self.directory + name + '.pkl'
+
+    def _meta_path(self, name):
+        return self.directory + name + '.meta.json'
+
+    def _columnar_path(self, name):
+        return self.directory + name + '.columnar'
@@ -13,10 +13,21 @@
 # 
 
 import os
+import struct
+import warnings
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 
-import cv2  
 import numpy as np
 from PIL import Image
+import rasterio
+from rasterio import features
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+import shapely
+from shapely.geometry import box
 from tqdm import tqdm
 
 from .data_processor_base_class import DataProcessorBaseClass
@@ -51,6 +62,16 @@ class MaskGenerator(DataProcessorBaseClass):
         The minimum border width.
     max_border_width : float
         The maximum border width.
+    engine : str
+        The mask engine: 'raster' burns the colored polygons directly into a
+        label raster, 'preview' extracts the masks from preview.png.
+    tiled : bool
+        Whether to generate and merge the masks by windows of rows instead of
+        whole images.
+    tile_size : int
+        The size of the Enfusion tiles.
+    window_tiles : int
+        The size of the windows in tiles, when tiled is True.
     colored_polygons : list
         A list of ColoredPolygon objects.
     """
@@ -64,7 +85,13 @@ class MaskGenerator(DataProcessorBaseClass):
             palette,
             enfusion_texture_masks,
             min_border_width=0.1,
-            max_border_width=5):
+            max_border_width=5,
+            engine='raster',
+            tiled=False,
+            tile_size=512,
+            window_tiles=4,
+            colored_polygons=None,
+            polygon=None):
         """
         Constructs all the necessary attributes for the MaskGenerator object.
 
@@ -88,6 +115,19 @@ class MaskGenerator(DataProcessorBaseClass):
             The minimum border width.
         max_border_width : float
             The maximum border width.
+        engine : str, optional
+            The mask engine, 'raster' or 'preview' (default is 'raster').
+        tiled : bool, optional
+            Whether to work by windows to bound memory usage (default is False).
+            Only the 'raster' engine supports it.
+        tile_size : int, optional
+            The size of the Enfusion tiles (default is 512).
+        window_tiles : int, optional
+            The size of the windows in tiles (default is 4).
+        colored_polygons : list, optional
+            The colored polygons, if they are already in memory. Otherwise, they are loaded from the data directory.
+        polygon : MultiPolygon, optional
+            The main polygon, if it is already in memory. Otherwise, it is loaded from the data directory.
         """
         super().__init__(source_path=source_path, save_path=save_path, save_data_path=save_data_path, svg_path=svg_path, svg_height=svg_height, svg_width=svg_width)
         self.source_path = source_path
@@ -97,39 +137,242 @@ class MaskGenerator(DataProcessorBaseClass):
         self.enfusion_texture_masks = enfusion_texture_masks
         self.min_border_width = min_border_width
         self.max_border_width = max_border_width
-        self.colored_polygons = None
+        self.engine = engine
+        self.tiled = tiled
+        self.tile_size = tile_size
+        self.window_tiles = window_tiles
+        self.colored_polygons = colored_polygons
+        self.polygon = polygon
 
     def process(self):
         """
-        Processes the image and generates masks for each color in the palette.
+        Generates masks for each color in the palette, with the engine selected
+        by the engine attribute.
 
         The masks are saved as PNG files in the save path.
         """
-        # Define your fixed color palette
-        palette = self.palette
+        if self.tiled and self.engine != 'raster':
+            raise ValueError("Tiled mask generation requires the 'raster' mask engine.")
+        if self.engine == 'raster' and self.tiled:
+            self._process_tiled()
+        elif self.engine == 'raster':
+            self._process_raster()
+        elif self.engine == 'preview':
+            self._process_preview()
+        else:
+            raise ValueError(f"Unknown mask engine: {self.engine}. Choose 'raster' or 'preview'.")
+
+    def _process_raster(self):
+        """
+        Burns the colored polygons straight into a label raster and generates
+        the masks from it, without going through preview.png.
+
+        Each pixel of the label raster holds the palette index of its polygon
+        plus one, 0 meaning no polygon. The polygon borders are burnt as 0, with
+        the width they have in the preview, so that fields stay separated.
+        """
+        try:
+            if self.colored_polygons is None:
+                self.colored_polygons = self.load_geometries('colored')
+        except FileNotFoundError:
+            raise FileNotFoundError("Colored polygons data are missing. Please run the VoronoiColorer class first!")
+
+        description = "Generating masks"
+        description += " " * (26 - len(description))
+        pbar = tqdm(total=len(self.palette) + 1, desc=description, unit=" step")
+
+        shapes = self._label_shapes(self.colored_polygons)
+        labels = self._rasterize_window(shapes, 0, 0, self.svg_height, self.svg_width)
+        pbar.update(1)
+
+        self._save_masks(labels, pbar)
+        pbar.close()
+
+    def _process_tiled(self):
+        """
+        Generates the masks window by window, so that memory usage depends on
+        the window size and not on the map size.
+
+        The map is cut into bands of window_tiles * tile_size rows, and each band
+        into windows of as many columns. Each window is rasterized with the
+        polygons that intersect it only, and each band is appended to the PNG
+        files of the masks before the next one is processed.
+        """
+        try:
+            if self.colored_polygons is None:
+                self.colored_polygons = self.load_geometries('colored')
+        except FileNotFoundError:
+            raise FileNotFoundError("Colored polygons data are missing. Please run the VoronoiColorer class first!")
+
+        shapes = self._label_shapes(self.colored_polygons)
+        tree = shapely.STRtree([shape for shape, label in shapes])
+        window = self.tile_size * self.window_tiles
 
+        description = "Generating masks"
+        description += " " * (26 - len(description))
+        with ExitStack() as stack:
+            writers = [stack.enter_context(_PNGStripWriter(f'{self.save_path}/mask_{color.lstrip("#")}.png', self.svg_width, self.svg_height)) 
+                       for color in self.palette]
+            for row in tqdm(range(0, self.svg_height, window), desc=description, unit=" band"):
+                height = min(window, self.svg_height - row)
+                labels = np.empty((height, self.svg_width), dtype=np.uint8)
+                for col in range(0, self.svg_width, window):
+                    width = min(window, self.svg_width - col)
+                    labels[:, col:col + width] = self._rasterize_window(shapes, row, col, height, width, tree)
+                for i, writer in enumerate(writers):
+                    writer.write((labels == i + 1).astype('uint8') * 255)
+
+    def _label_shapes(self, colored_polygons):
+        """
+        Builds the (geometry, label) pairs to burn into the label raster.
+
+        Parameters
+        ----------
+        colored_polygons : list
+            A list of ColoredPolygon objects.
+
+        Returns
+        -------
+        list
+            The (geometry, label) pairs in burning order: palette index + 1 for
+            the polygons, 0 for their borders.
+        """
+        palette_index = {color: i + 1 for i, color in enumerate(self.palette)}
+        # The preview is rendered at 100 dpi and line widths are expressed in points
+        border_scale = 100 / 72
+
+        # Shapes are burnt in order, so each polygon border is drawn over its fill
+        # and the next polygons are drawn over it, like matplotlib does in the preview
+        shapes = []
+        for colored_polygon in colored_polygons:
+            label = palette_index.get(colored_polygon.color)
+            if label is None or colored_polygon.polygon.is_empty:
+                continue
+            shapes.append((colored_polygon.polygon, label))
+            if colored_polygon.border_width:
+                border = colored_polygon.polygon.exterior.buffer(colored_polygon.border_width * border_scale / 2)
+                shapes.append((border, 0))
+        return shapes
+
+    def _rasterize_window(self, shapes, row, col, height, width, tree=None):
+        """
+        Rasterizes shapes into a uint8 label raster covering a window of the map.
+
+        Parameters
+        ----------
+        shapes : list
+            The (geometry, label) pairs returned by _label_shapes.
+        row : int
+            The first row of the window, from the top of the map.
+        col : int
+            The first column of the window.
+        height : int
+            The height of the window.
+        width : int
+            The width of the window.
+        tree : shapely.STRtree, optional
+            A STRtree of the shape geometries. If given, only the shapes that
+            intersect the window are rasterized.
+
+        Returns
+        -------
+        numpy.ndarray
+            The label raster of the window, 0 where there is no polygon.
+        """
+        if tree is not None:
+            window_box = box(col, self.svg_height - row - height, col + width, self.svg_height - row)
+            # Sorting keeps the burning order of the shapes
+            shapes = [shapes[i] for i in np.sort(tree.query(window_box, predicate='intersects'))]
+
+        labels = np.zeros((height, width), dtype=np.uint8)
+        if shapes:
+            # SVG coordinates have their origin at the bottom left, image rows start at the top
+            transform = from_origin(col, self.svg_height - row, 1, 1)
+            features.rasterize(shapes, out=labels, transform=transform)
+        return labels
+
+    def _process_preview(self):
+        """
+        Processes the image and generates masks for each color in the palette.
+
+        The masks are saved as PNG files in the save path.
+        """
         # Load the image from the file saved by VoronoiColorer
         img = Image.open(f'{self.save_path}/preview.png')
         data = np.array(img)
 
-        # For each color in the palette
         description = "Generating masks"
         description += " " * (26 - len(description))
-        for i, color in tqdm(enumerate(palette), desc=description, total=len(palette), unit=" step"):
+        pbar = tqdm(total=len(self.palette) + 1, desc=description, unit=" step")
+
+        # Classify every pixel at once, then derive the masks from the label raster
+        labels = self._classify_palette(data)
+        del data
+        pbar.update(1)
+
+        self._save_masks(labels, pbar)
+        pbar.close()
+
+    def _classify_palette(self, data, chunk_rows=1024):
+        """
+        Classifies the pixels of an RGB(A) image by palette color in a single pass.
+
+        The RGB channels of each pixel are packed into one uint32 key, which is
+        mapped to a palette index through a lookup table covering every RGB
+        value, so the cost does not depend on the size of the palette. Rows are
+        processed by chunks to keep the packed keys small.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            A (height, width, 3 or 4) uint8 array.
+        chunk_rows : int, optional
+            The number of rows classified at once (default is 1024).
+
+        Returns
+        -------
+        numpy.ndarray
+            The label raster: palette index + 1 where the pixel has a palette
+            color, 0 elsewhere.
+        """
+        lookup = np.zeros(1 << 24, dtype=np.uint8)
+        # Iterate backwards so that the first occurrence wins if a color is repeated
+        for i, color in reversed(list(enumerate(self.palette))):
+            lookup[int(color.lstrip('#')[:6], 16)] = i + 1
+
+        labels = np.empty(data.shape[:2], dtype=np.uint8)
+        for row in range(0, data.shape[0], chunk_rows):
+            rgb = data[row:row + chunk_rows, :, :3]
+            key = rgb[:, :, 0].astype(np.uint32) << 16
+            key |= rgb[:, :, 1].astype(np.uint32) << 8
+            key |= rgb[:, :, 2]
+            labels[row:row + chunk_rows] = lookup[key]
+        return labels
+
+    def _save_masks(self, labels, pbar=None):
+        """
+        Saves the mask of each color in the palette from a label raster.
+
+        Parameters
+        ----------
+        labels : numpy.ndarray
+            The label raster: palette index + 1 where the pixel has a palette
+            color, 0 elsewhere.
+        pbar : tqdm.tqdm, optional
+            A progress bar updated after each mask.
+        """
+        for i, color in enumerate(self.palette):
             # Remove the '#' from the color string
             color = color.lstrip('#')
 
-            # Convert the color to RGB format
-            rgb_color = tuple(int(color[i:i+2], 16) for i in (0, 2, 4))
-
-            # Create a mask with the same shape as the image data
-            mask = np.all(data[:, :, :3] == rgb_color, axis=-1)  # Only use the first three channels (RGB)
+            # Create the mask of the color from the label raster
+            mask = labels == i + 1
 
-            # Convert the mask to an image
+            # Convert the mask to an image and save it to a new PNG file
             mask_img = Image.fromarray(mask.astype('uint8') * 255)
-
-            # Save the mask image to a new PNG file
             mask_img.save(f'{self.save_path}/mask_{color}.png')
+            if pbar is not None:
+                pbar.update(1)
 
     def merge_masks(self, reset=True):
         """
@@ -140,60 +383,211 @@ class MaskGenerator(DataProcessorBaseClass):
         reset : bool, optional
             Whether to reset the external masks before merging (default is True).
 
-        The merged masks are saved as PNG files in the save path.
+        The main polygon is rasterized once and the masks are merged
+        concurrently, one job per external mask. The merged masks are saved as
+        PNG files in the save path.
         """
         if self.enfusion_texture_masks is None:
             return
+
+        if self.tiled:
+            self._merge_masks_tiled(reset)
+            return
     
-        # Get the list of external mask files
+        # Get the list of external mask files, one for each color of the palette
         external_mask_files = [file for key, file in self.enfusion_texture_masks.items() if key != "etm_path"]
-    
-        # For each color in the palette
+        merges = list(zip(self.palette, external_mask_files))
+        if not merges:
+            return
+
+        # The stencil of the main polygon is the same for every external mask
+        stencil = None
+        if reset:
+            multipolygon = self.polygon if self.polygon is not None else self.load_geometries('polygon')
+            stencil = self._reset_stencil(shapely.STRtree(list(multipolygon.geoms)), 0, self.svg_height)
+
         description = "Merging masks"
         description += " " * (26 - len(description))
-        for i, color in tqdm(enumerate(self.palette), desc=description, total=len(self.palette), unit=" step"):
-        # Remove the '#' from the color string
-            color = color.lstrip('#')
-        
-            # Load the mask generated by the process method
-            mask_img = Image.open(f'{self.save_path}/mask_{color}.png')
-            mask = np.array(mask_img)
-        
-           # If there is an external mask file for this color
-            if i < len(external_mask_files):
-                # Load the external mask
-                external_mask_file = external_mask_files[i]
-                external_mask_img = Image.open(f'{self.enfusion_texture_masks["etm_path"]}/{external_mask_file}')
-                external_mask = np.array(external_mask_img)
-
-                if reset:
-                    # Load the polygon from the pickle file
-                    multipolygon = self.load('polygon.pkl', data_file=True)
-
-                    # Iterate over the polygons in the MultiPolygon
-                    for polygon in multipolygon.geoms:
-                        # Convert the polygon points to integer
-                        polygon = np.round(np.array(polygon.exterior.coords)).astype(int)
-
-                        # Correct the y coordinates
-                        polygon[:, 1] = self.svg_height - polygon[:, 1]
-
-                        # Reshape the polygon to meet the requirements of cv2.fillPoly()
-                        polygon = polygon.reshape((-1, 1, 2))
-
-                        # Draw a black polygon on the external mask
-                        cv2.fillPoly(external_mask, [polygon], color=0)
-
-                # Merge the masks
-                mask = np.where((mask > 0) & (external_mask != 255), 255, external_mask)
-
-                # Convert the merged mask to an image
-                merged_mask_img = Image.fromarray(mask.astype('uint8'))
-
-                # Get the base name of the external mask file (without the directory path and extension)
+        # PIL and NumPy release the GIL while decoding, merging and encoding, so threads run in parallel
+        with ThreadPoolExecutor(max_workers=len(merges)) as executor:
+            jobs = [executor.submit(self._merge_mask, color, external_mask_file, stencil) for color, external_mask_file in merges]
+            for job in tqdm(as_completed(jobs), desc=description, total=len(jobs), unit=" step"):
+                job.result()
+
+    def _merge_mask(self, color, external_mask_file, stencil=None):
+        """
+        Merges the mask of a color with an external mask and saves the result.
+
+        Parameters
+        ----------
+        color : str
+            The color of the mask, as in the palette.
+        external_mask_file : str
+            The file name of the external mask.
+        stencil : numpy.ndarray, optional
+            The stencil of the main polygon, where the external mask is reset
+            before merging (default is None, no reset).
+        """
+        # Load the mask generated by the process method
+        mask_img = Image.open(f'{self.save_path}/mask_{color.lstrip("#")}.png')
+        mask = np.array(mask_img)
+
+        # Load the external mask
+        external_mask_img = Image.open(f'{self.enfusion_texture_masks["etm_path"]}/{external_mask_file}')
+        external_mask = np.array(external_mask_img)
+
+        if stencil is not None:
+            # Draw the main polygon in black on the external mask
+            external_mask[stencil > 0] = 0
+
+        # Merge the masks
+        mask = np.where((mask > 0) & (external_mask != 255), 255, external_mask)
+
+        # Convert the merged mask to an image
+        merged_mask_img = Image.fromarray(mask.astype('uint8'))
+
+        # Get the base name of the external mask file (without the directory path and extension)
+        external_mask_basename, extension = os.path.splitext(os.path.basename(external_mask_file))
+
+        # Save the merged mask image to a new PNG file, named after the external mask with the new suffix
+        merged_mask_img.save(f'{self.save_path}/{external_mask_basename}_AFG_merged{extension}')
+
+    def _merge_masks_tiled(self, reset=True):
+        """
+        Merges the generated masks with external masks band by band, so that
+        memory usage depends on the window size and not on the map size.
+
+        Parameters
+        ----------
+        reset : bool, optional
+            Whether to reset the external masks before merging (default is True).
+        """
+        external_mask_files = [file for key, file in self.enfusion_texture_masks.items() if key != "etm_path"]
+        merges = list(zip(self.palette, external_mask_files))
+        window = self.tile_size * self.window_tiles
+
+        tree = None
+        if reset:
+            multipolygon = self.polygon if self.polygon is not None else self.load_geometries('polygon')
+            tree = shapely.STRtree(list(multipolygon.geoms))
+
+        description = "Merging masks"
+        description += " " * (26 - len(description))
+        with ExitStack() as stack, warnings.catch_warnings():
+            # PNG masks have no georeferencing, which is expected here
+            warnings.simplefilter('ignore', NotGeoreferencedWarning)
+            sources = []
+            for color, external_mask_file in merges:
                 external_mask_basename, extension = os.path.splitext(os.path.basename(external_mask_file))
+                mask = stack.enter_context(rasterio.open(f'{self.save_path}/mask_{color.lstrip("#")}.png'))
+                external_mask = stack.enter_context(rasterio.open(f'{self.enfusion_texture_masks["etm_path"]}/{external_mask_file}'))
+                writer = stack.enter_context(_PNGStripWriter(f'{self.save_path}/{external_mask_basename}_AFG_merged{extension}', self.svg_width, self.svg_height))
+                sources.append((mask, external_mask, writer))
+
+            def merge_band(source, band, stencil):
+                mask_source, external_source, writer = source
+                mask = mask_source.read(1, window=band)
+                external_mask = external_source.read(1, window=band)
+                if stencil is not None:
+                    external_mask[stencil > 0] = 0
+                merged = np.where((mask > 0) & (external_mask != 255), 255, external_mask)
+                writer.write(merged.astype('uint8'))
+
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=max(len(sources), 1)))
+            for row in tqdm(range(0, self.svg_height, window), desc=description, unit=" band"):
+                height = min(window, self.svg_height - row)
+                band = Window(0, row, self.svg_width, height)
+                # The stencil of the band is computed once and shared by every external mask
+                stencil = self._reset_stencil(tree, row, height) if reset else None
+                for job in [executor.submit(merge_band, source, band, stencil) for source in sources]:
+                    job.result()
+
+    def _reset_stencil(self, tree, row, height):
+        """
+        Rasterizes the main polygon over a band of rows, to reset the external
+        masks where the fields are generated.
+
+        The exterior of each polygon is burnt with all the pixels it touches,
+        like cv2.fillPoly does, and the result does not depend on the band.
+
+        Parameters
+        ----------
+        tree : shapely.STRtree
+            A STRtree of the polygons of the main polygon.
+        row : int
+            The first row of the band, from the top of the map.
+        height : int
+            The height of the band.
+
+        Returns
+        -------
+        numpy.ndarray
+            A (height, svg_width) uint8 array, 1 inside the main polygon.
+        """
+        band_box = box(0, self.svg_height - row - height, self.svg_width, self.svg_height - row)
+        polygons = tree.geometries.take(np.sort(tree.query(band_box, predicate='intersects')))
+        stencil = np.zeros((height, self.svg_width), dtype=np.uint8)
+        if len(polygons):
+            exteriors = shapely.polygons(shapely.get_exterior_ring(polygons))
+            transform = from_origin(0, self.svg_height - row, 1, 1)
+            features.rasterize(((exterior, 1) for exterior in exteriors), out=stencil, transform=transform, all_touched=True)
+        return stencil
 
-                # Save the merged mask image to a new PNG file, named after the external mask with the new suffix
-                merged_mask_img.save(f'{self.save_path}/{external_mask_basename}_AFG_merged{extension}')
-                
 
+class _PNGStripWriter:
+    """
+    Writes a 8-bit grayscale PNG file strip by strip, so that the whole image
+    never has to be held in memory. Rows are stored with the PNG 'Up' filter.
+    """
+    def __init__(self, path, width, height, compression_level=6):
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.previous_row = np.zeros(width, dtype=np.uint8)
+        self.compressor = zlib.compressobj(compression_level)
+        self.file = open(path, 'wb')
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+    def write(self, strip):
+        """
+        Appends rows to the image.
+
+        Parameters
+        ----------
+        strip : numpy.ndarray
+            A (rows, width) uint8 array.
+        """
+        filtered = np.empty((strip.shape[0], self.width + 1), dtype=np.uint8)
+        filtered[:, 0] = 2  # Up filter: each row is stored as its difference with the previous one
+        filtered[0, 1:] = strip[0] - self.previous_row
+        filtered[1:, 1:] = strip[1:] - strip[:-1]
+        self.previous_row = strip[-1].copy()
+        self.rows_written += strip.shape[0]
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self._write_chunk(b'IDAT', data)
+
+    def close(self):
+        """
+        Writes the end of the image and closes the file.
+        """
+        if self.rows_written != self.height:
+            self.file.close()
+            raise ValueError(f"{self.rows_written} rows written, {self.height} expected.")
+        self._write_chunk(b'IDAT', self.compressor.flush())
+        self._write_chunk(b'IEND', b'')
+        self.file.close()
+
+    def _write_chunk(self, chunk_type, data):
+        self.file.write(struct.pack('>I', len(data)) + chunk_type + data)
+        self.file.write(struct.pack('>I', zlib.crc32(chunk_type + data)))
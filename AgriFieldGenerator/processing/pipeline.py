@@ -0,0 +1,482 @@
+# Copyright (c) [2024] [Didier ALAIN]
+# Repository: https://github.com/Tanin69/AgriFieldGenerator
+#
+# The project makes it possible to generate patterns of large cultivated fields
+# reproducing as believable as possible the diversity of agricultural
+# landscapes. It allows you to generate texture masks that can be used in the
+# world editor of the Enfusion Workbench.
+#
+# It is released under the MIT License. Please see the LICENSE file for details.
+#
+# Enfusion is a game engine developed by Bohemia Interactive for the Arma game series
+# The Enfusion Workbench is a creation workbench dedicated to the Enfusion engine.
+#
+
+import json
+import os
+
+class Pipeline:
+    """
+    A class used to run the processors one after the other, in the same process.
+    Each processor module is only imported when its stage runs.
+
+    The artifacts produced by a stage (the main polygon, the seed points, the
+    Voronoi polygons and the colored polygons) are kept in memory and passed to
+    the next stages, instead of being reloaded from the data directory by each
+    processor. An artifact that is not in memory is loaded from the data
+    directory by the processor that needs it, so that a stage can still be run
+    on its own, on the result of a previous run.
+
+    With checkpoint, the artifacts are also saved to the data directory, as
+    before. Without, only the final products (the SVG file, the masks and the
+    polylines) are written.
+
+    Example
+    -------
+    >>> pipeline = Pipeline.from_file('../config.json', checkpoint=False)
+    >>> pipeline.run_all()
+
+    Attributes
+    ----------
+    config : dict
+        The configuration, as read from config.json.
+    generator : str
+        The point generator: 'random', 'grid', 'rectangle' or 'rect_tiling'.
+    pp_curve : float
+        The probability to curve a border of the Voronoi diagram. 0 or None disables curving.
+    checkpoint : bool
+        Whether the artifacts are saved to the data directory.
+    seed : int
+        The seed of the random generators, or None for a different result at each run.
+    simplification : dict
+        The tolerance and the vertex counts of the last simplification of the main polygon, or None.
+        They are also saved in the metadata of the polygon artifact (see GeometryStore.load_meta).
+    artifacts : dict
+        The artifacts in memory: 'polygon', 'points', 'voronoi', 'adjacency' and 'colored'.
+
+    Methods
+    -------
+    from_file(config_file, **kwargs)
+        Creates a pipeline from a configuration file.
+    create_svg()
+        Generates the SVG file from the Enfusion spline layer file.
+    create_polygon(simplify=True)
+        Generates the main polygon from the SVG file.
+    simplify_polygon(tolerance=None)
+        Simplifies the main polygon.
+    create_points()
+        Generates the seed points.
+    create_voronoi(pp_curve=None)
+        Generates the Voronoi diagram, and curves its borders.
+    color_voronoi()
+        Colors the Voronoi diagram.
+    create_masks()
+        Generates the masks.
+    merge_masks()
+        Merges the masks with the Enfusion texture masks.
+    create_polylines()
+        Generates the polylines of the colored polygons.
+    display(file_to_display)
+        Displays the result of a processor.
+    run_all(use_cache=True)
+        Runs all the stages.
+    """
+    # The artifacts that are invalidated when a stage runs again
+    DOWNSTREAM = {
+        'polygon': ['points', 'voronoi', 'adjacency', 'colored'],
+        'points': ['voronoi', 'adjacency', 'colored'],
+        'voronoi': ['adjacency', 'colored'],
+        'adjacency': [],
+        'colored': [],
+    }
+    # The key of the child seed of each stage that draws random numbers. A stage always gets the same child
+    # seed, whatever the stages that have run or been skipped before it
+    SEED_KEYS = {
+        'points': 0,
+        'voronoi': 1,
+        'colorer': 2,
+        'polylines': 3,
+    }
+
+    def __init__(self, config, generator='random', pp_curve=0.5, checkpoint=True, seed=None):
+        """
+        Constructs all the necessary attributes for the Pipeline object.
+
+        Parameters
+        ----------
+        config : dict
+            The configuration, with the structure of config.json.
+        generator : str, optional
+            The point generator (default is 'random').
+        pp_curve : float, optional
+            The probability to curve a border of the Voronoi diagram (default is 0.5).
+        checkpoint : bool, optional
+            Whether to save the artifacts to the data directory (default is True).
+        seed : int, optional
+            The seed of the random generators (default is the seed of the configuration, if any).
+        """
+        self.config = config
+        self.generator = generator
+        self.pp_curve = pp_curve
+        self.checkpoint = checkpoint
+        self.artifacts = {}
+
+        self.project_name = config['project_name']
+        self.enfusion_texture_masks = config['enfusion_texture_masks']
+        self.enfusion_surface_map_resolution = config['enfusion_surface_map_resolution']
+        self.palette = config['palette']
+        self.enfusion_spline_layer_file = config['source_files']['enfusion_spline_layer_file']
+        self.svg_height = config['source_files']['svg_height']
+        self.svg_width = config['source_files']['svg_width']
+        self.tile_size = config['source_files']['tile_size']
+        project_dir = config['work_dir'] + self.project_name + "/"
+        self.source_path = project_dir + config['paths']['source_dir']
+        self.save_path = project_dir + config['paths']['save_dir']
+        self.save_data_path = self.save_path + config['paths']['save_data_dir']
+        self.svg_path = self.source_path + config['source_files']['svg_file_name']
+        self.polygon_source = config['source_files'].get('polygon_source', 'svg')
+        self.flattening_tolerance = config['source_files'].get('flattening_tolerance', 0.1)
+        self.simplify_tolerance = config.get('simplification', {}).get('tolerance', 0)
+        self.min_border_width = config['borders']['min_border_width']
+        self.max_border_width = config['borders']['max_border_width']
+        self.point_generators = config['point_generators']
+        self.mask_engine = config.get('masks', {}).get('engine', 'raster')
+        self.preview = config.get('masks', {}).get('preview', True)
+        self.tiled_masks = config.get('masks', {}).get('tiled', False)
+        self.window_tiles = config.get('masks', {}).get('window_tiles', 4)
+        self.polygon_format = config.get('artifacts', {}).get('polygon', 'columnar')
+        self.voronoi_format = config.get('artifacts', {}).get('voronoi', 'columnar')
+        self.colored_format = config.get('artifacts', {}).get('colored', 'columnar')
+        self.seed = config.get('seed') if seed is None else seed
+        self.simplification = None
+
+    @classmethod
+    def from_file(cls, config_file, **kwargs):
+        """
+        Creates a pipeline from a configuration file.
+
+        Parameters
+        ----------
+        config_file : str
+            The path to the configuration file.
+        **kwargs
+            The other arguments of the constructor.
+
+        Returns
+        -------
+        Pipeline
+            The new pipeline.
+        """
+        with open(config_file) as f:
+            config = json.load(f)
+        return cls(config, **kwargs)
+
+    def create_svg(self):
+        """
+        Generates the SVG file from the Enfusion spline layer file.
+        """
+        spline_to_svg = self._spline_to_svg()
+        splines = spline_to_svg.parse_spline_file()
+        spline_to_svg.hermite_to_bezier(splines)
+
+    def create_polygon(self, simplify=True):
+        """
+        Generates the main polygon, and the list of the Enfusion tiles it covers. The polygon is generated from
+        the SVG file, or straight from the Enfusion spline layer file if the polygon source is 'splines'. It is
+        then simplified if the simplification tolerance is not 0.
+
+        Parameters
+        ----------
+        simplify : bool, optional
+            Whether to simplify the polygon with the simplification tolerance of the pipeline (default is True).
+            False when simplify_polygon is called next with another tolerance, so that it is not simplified twice.
+
+        Returns
+        -------
+        MultiPolygon
+            The main polygon.
+        """
+        from .svg_to_polygon import SVGToPolygon
+
+        svg_to_polygon = SVGToPolygon(self.source_path, self.save_path, self.save_data_path, self.svg_path, self.svg_height, self.svg_width, self.tile_size, self.flattening_tolerance, self.polygon_format, checkpoint=self.checkpoint)
+        if self.polygon_source == 'splines':
+            spline_to_svg = self._spline_to_svg()
+            self._set('polygon', svg_to_polygon.process_splines(spline_to_svg.bezier_paths(spline_to_svg.parse_spline_file())))
+        elif self.polygon_source == 'svg':
+            self._set('polygon', svg_to_polygon.process())
+        else:
+            raise ValueError(f"Unknown polygon source: {self.polygon_source}")
+        svg_to_polygon.get_polygon_tiles()
+        if simplify and self.simplify_tolerance:
+            self.simplify_polygon()
+        return self.artifacts['polygon']
+
+    def simplify_polygon(self, tolerance=None):
+        """
+        Simplifies the main polygon, preserving its topology.
+
+        Parameters
+        ----------
+        tolerance : float, optional
+            The maximum distance, in pixels, between the main polygon and its simplified version (default is
+            the simplification tolerance of the pipeline).
+
+        Returns
+        -------
+        MultiPolygon
+            The simplified main polygon.
+        """
+        from .polygon_simplifier import PolygonSimplifier
+
+        tolerance = self.simplify_tolerance if tolerance is None else tolerance
+        polygon_simplifier = PolygonSimplifier(self.source_path, self.save_path, self.save_data_path, self.svg_path, self.svg_height, self.svg_width, tolerance, self.polygon_format,
+                                               polygon=self.artifacts.get('polygon'), checkpoint=self.checkpoint)
+        self._set('polygon', polygon_simplifier.process())
+        self.simplification = polygon_simplifier.statistics()
+        return self.artifacts['polygon']
+
+    def create_points(self):
+        """
+        Generates the seed points with the generator of the pipeline.
+
+        Returns
+        -------
+        numpy.ndarray
+            The (N, 2) array of seed points.
+        """
+        from .points_generator import PointsGenerator
+
+        random = self.point_generators['random']
+        grid = self.point_generators['grid']
+        rectangle = self.point_generators['rectangle']
+        points_generator = PointsGenerator(
+                                        self.source_path,
+                                        self.save_path,
+                                        self.save_data_path,
+                                        self.svg_path,
+                                        self.svg_height,
+                                        self.svg_width,
+                                        random['num_points'],
+                                        grid['nx'],
+                                        grid['ny'],
+                                        grid['rand_offset_x'],
+                                        grid['rand_offset_y'],
+                                        grid['rand_step_x'],
+                                        grid['rand_step_y'],
+                                        grid['angle'],
+                                        rectangle['num_rectangles'],
+                                        rectangle['min_width'],
+                                        rectangle['max_width'],
+                                        rectangle['min_height'],
+                                        rectangle['max_height'],
+                                        polygon=self.artifacts.get('polygon'),
+                                        checkpoint=self.checkpoint,
+                                        seed=self._seed_sequence('points')
+                                        )
+        if self.generator == 'random':
+            points = points_generator.random_generator()
+        elif self.generator == 'grid':
+            points = points_generator.grid_generator()
+        elif self.generator == 'rectangle':
+            points = points_generator.rectangle_generator()
+        elif self.generator == 'rect_tiling':
+            points = points_generator.rectangle_tiling_generator()
+        else:
+            raise ValueError(f"Unknown point generator: {self.generator}")
+        self.artifacts['polygon'] = points_generator.polygon
+        self._set('points', points)
+        return points
+
+    def create_voronoi(self, pp_curve=None):
+        """
+        Generates the Voronoi diagram, and curves some of its borders. Both steps share the same VoronoiFiller.
+
+        Parameters
+        ----------
+        pp_curve : float, optional
+            The probability to curve a border (default is the pp_curve of the pipeline). 0 disables curving.
+
+        Returns
+        -------
+        list
+            The Voronoi polygons.
+        """
+        from .voronoi_filler import VoronoiFiller
+
+        pp_curve = self.pp_curve if pp_curve is None else pp_curve
+        voronoi_filler = VoronoiFiller(self.source_path, self.save_path, self.save_data_path, self.svg_path, self.svg_height, self.svg_width, self.voronoi_format,
+                                       polygon=self.artifacts.get('polygon'), points=self.artifacts.get('points'), checkpoint=self.checkpoint,
+                                       seed=self._seed_sequence('voronoi'))
+        voronoi = voronoi_filler.process()
+        if pp_curve:
+            voronoi = voronoi_filler.pp_curve_voronoi_edges(pp_curve)
+        self.artifacts['polygon'] = voronoi_filler.polygon
+        self.artifacts['points'] = voronoi_filler.points
+        self._set('voronoi', voronoi)
+        self._set('adjacency', voronoi_filler.adjacency)
+        return voronoi
+
+    def color_voronoi(self):
+        """
+        Colors the Voronoi diagram.
+
+        Returns
+        -------
+        list
+            The ColoredPolygon objects.
+        """
+        from .voronoi_colorer import VoronoiColorer
+
+        voronoi_colorer = VoronoiColorer(self.project_name, self.source_path, self.save_path, self.save_data_path, self.svg_path, self.svg_height, self.svg_width,
+                                         self.palette, self.min_border_width, self.max_border_width, self.preview, self.colored_format,
+                                         polygon=self.artifacts.get('polygon'), points=self.artifacts.get('points'), voronoi=self.artifacts.get('voronoi'),
+                                         adjacency=self.artifacts.get('adjacency'), checkpoint=self.checkpoint, seed=self._seed_sequence('colorer'))
+        colored = voronoi_colorer.process()
+        self._set('colored', colored)
+        return colored
+
+    def create_masks(self):
+        """
+        Generates the masks of the colors of the palette.
+        """
+        self._mask_generator().process()
+
+    def merge_masks(self):
+        """
+        Merges the masks with the Enfusion texture masks.
+        """
+        self._mask_generator().merge_masks()
+
+    def create_polylines(self):
+        """
+        Generates the Enfusion polylines of the colored polygons, written to the polylines_colored.layer file.
+
+        Returns
+        -------
+        int
+            The number of polylines.
+        """
+        from .polyline_generator import PolylineGenerator
+
+        polyline_generator = PolylineGenerator(self.enfusion_surface_map_resolution, self.save_path, self.save_data_path, colored_polygons=self.artifacts.get('colored'),
+                                               seed=self._seed_sequence('polylines'))
+        return polyline_generator.generate_polylines()
+
+    def display(self, file_to_display):
+        """
+        Displays the result of a processor: 'main_polygon', 'seed_points' or 'voronoi'.
+        """
+        from .data_processor_base_class import DataProcessorBaseClass
+
+        data_processor = DataProcessorBaseClass(self.source_path, self.save_path, self.save_data_path, self.svg_path, self.svg_height, self.svg_width)
+        data_processor.display(file_to_display)
+
+    def run_all(self, use_cache=True):
+        """
+        Runs all the stages.
+
+        With checkpoint, a stage is skipped when the configuration values and the files it depends on have not
+        changed since its last run (see StageCache), unless use_cache is False. Without checkpoint, there are no
+        files to compare, so all the stages run.
+
+        Parameters
+        ----------
+        use_cache : bool, optional
+            Whether to skip the stages that are up to date (default is True).
+        """
+        # With the 'splines' polygon source, the SVG file is only an export: it is not needed to run all the stages
+        if not self.checkpoint:
+            if self.polygon_source == 'svg':
+                self.create_svg()
+            self.create_polygon()
+            self.create_points()
+            self.create_voronoi()
+            self.color_voronoi()
+            self.create_masks()
+            self.merge_masks()
+            self.create_polylines()
+            return
+
+        from .geometry_store import GeometryStore
+        from .stage_cache import StageCache
+
+        cache = StageCache(self.save_data_path, enabled=use_cache)
+        geometry_store = GeometryStore(self.save_data_path)
+        polygon = geometry_store.path('polygon', self.polygon_format)
+        points = self.save_data_path + 'points.npy'
+        voronoi = geometry_store.path('voronoi', self.voronoi_format)
+        adjacency = self.save_data_path + 'adjacency.pkl'
+        colored = geometry_store.path('colored', self.colored_format)
+        preview = [self.save_path + 'preview.png'] if self.preview else []
+        masks = [f'{self.save_path}/mask_{color.lstrip("#")}.png' for color in self.palette]
+        # Without Enfusion texture masks, there is nothing to merge (see MaskGenerator.merge_masks)
+        if self.enfusion_texture_masks is None:
+            external_mask_files = []
+            external_masks = []
+        else:
+            external_mask_files = [file for key, file in self.enfusion_texture_masks.items() if key != "etm_path"]
+            external_masks = [f'{self.enfusion_texture_masks["etm_path"]}/{file}' for file in external_mask_files]
+        merged_masks = [f'{self.save_path}/{os.path.splitext(file)[0]}_AFG_merged{os.path.splitext(file)[1]}' for file in external_mask_files[:len(self.palette)]]
+        mask_config = {'palette': self.palette, 'engine': self.mask_engine, 'tiled': self.tiled_masks, 'tile_size': self.tile_size,
+                       'window_tiles': self.window_tiles, 'svg_height': self.svg_height, 'svg_width': self.svg_width}
+
+        if self.polygon_source == 'svg':
+            cache.run('svg', self.create_svg,
+                      config={'svg_height': self.svg_height, 'svg_width': self.svg_width, 'resolution': self.enfusion_surface_map_resolution},
+                      inputs=[self.source_path + self.enfusion_spline_layer_file], outputs=[self.svg_path])
+            polygon_inputs = [self.svg_path]
+        else:
+            polygon_inputs = [self.source_path + self.enfusion_spline_layer_file]
+        cache.run('polygon', self.create_polygon,
+                  config={'svg_height': self.svg_height, 'svg_width': self.svg_width, 'tile_size': self.tile_size, 'source': self.polygon_source,
+                          'resolution': self.enfusion_surface_map_resolution if self.polygon_source == 'splines' else None,
+                          'tolerance': self.flattening_tolerance, 'simplify_tolerance': self.simplify_tolerance, 'format': self.polygon_format},
+                  inputs=polygon_inputs, outputs=[polygon, self.save_path + 'polygon_tiles.txt'])
+        cache.run('points', self.create_points,
+                  config={'generator': self.generator, 'point_generators': self.point_generators, 'seed': self.seed},
+                  inputs=[polygon], outputs=[points])
+        cache.run('voronoi', self.create_voronoi,
+                  config={'pp_curve': self.pp_curve, 'format': self.voronoi_format, 'seed': self.seed},
+                  inputs=[polygon, points], outputs=[voronoi, adjacency])
+        cache.run('colorer', self.color_voronoi,
+                  config={'palette': self.palette, 'borders': self.config['borders'], 'preview': self.preview, 'format': self.colored_format,
+                          'seed': self.seed},
+                  inputs=[polygon, points, voronoi, adjacency], outputs=[colored] + preview)
+        cache.run('masks', self.create_masks,
+                  config=mask_config,
+                  inputs=[colored] + (preview if self.mask_engine == 'preview' else []), outputs=masks)
+        cache.run('merge', self.merge_masks,
+                  config=dict(mask_config, enfusion_texture_masks=self.enfusion_texture_masks),
+                  inputs=masks + external_masks + [polygon], outputs=merged_masks)
+        cache.run('polylines', self.create_polylines,
+                  config={'resolution': self.enfusion_surface_map_resolution, 'seed': self.seed},
+                  inputs=[colored], outputs=[self.save_path + 'polylines_colored.layer'])
+
+    def _spline_to_svg(self):
+        from .spline_to_svg import SplineToSVG
+
+        return SplineToSVG(self.source_path, self.save_path, self.save_data_path, self.svg_path, self.svg_height, self.svg_width, self.enfusion_surface_map_resolution, self.enfusion_spline_layer_file)
+
+    def _mask_generator(self):
+        from .mask_generator import MaskGenerator
+
+        return MaskGenerator(self.source_path, self.save_path, self.save_data_path, self.svg_path, self.svg_height, self.svg_width, self.palette, self.enfusion_texture_masks,
+                             engine=self.mask_engine, tiled=self.tiled_masks, tile_size=self.tile_size, window_tiles=self.window_tiles,
+                             colored_polygons=self.artifacts.get('colored'), polygon=self.artifacts.get('polygon'))
+
+    def _seed_sequence(self, stage):
+        """
+        Returns the child SeedSequence of a stage, spawned from the seed of the pipeline. Without seed, it draws
+        fresh entropy, and the stage gives a different result at each run.
+        """
+        import numpy as np
+
+        return np.random.SeedSequence(self.seed, spawn_key=(self.SEED_KEYS[stage],))
+
+    def _set(self, name, value):
+        """
+        Keeps an artifact in memory, and forgets the artifacts computed from its previous value.
+        """
+        self.artifacts[name] = value
+        for downstream in self.DOWNSTREAM[name]:
+            self.artifacts.pop(downstream, None)
@@ -15,7 +15,7 @@
 import os
 
 import numpy as np
-from shapely.geometry import Point
+import shapely
 from tqdm import tqdm
 
 from .data_processor_base_class import DataProcessorBaseClass
@@ -65,8 +65,8 @@ class PointsGenerator(DataProcessorBaseClass):
         Rectangle generator parameter : the minimum height of the rectangles.
     max_height : float
         Rectangle generator parameter : the maximum height of the rectangles.
-    points : list
-        The list of generated points.
+    points : numpy.ndarray
+        The (N, 2) array of generated points.
 
     Methods
     -------
@@ -79,6 +79,8 @@ class PointsGenerator(DataProcessorBaseClass):
     display():
         Displays the polygon and the generated points.
     """
+    # The minimum number of points within the polygon to build the Voronoi diagram
+    MIN_POINTS = 4
         
     def __init__(self,
                  source_path,
@@ -99,9 +101,12 @@ class PointsGenerator(DataProcessorBaseClass):
                  min_width,
                  max_width,
                  min_height,
-                 max_height):
+                 max_height,
+                 polygon=None,
+                 checkpoint=True,
+                 seed=None):
         
-        super().__init__(source_path=source_path, save_path=save_path, save_data_path=save_data_path, svg_path=svg_path, svg_height=svg_height, svg_width=svg_width)
+        super().__init__(source_path=source_path, save_path=save_path, save_data_path=save_data_path, svg_path=svg_path, svg_height=svg_height, svg_width=svg_width, checkpoint=checkpoint, seed=seed)
         
         self.source_path = source_path
         self.save_path = save_path
@@ -121,51 +126,88 @@ class PointsGenerator(DataProcessorBaseClass):
         self.max_height = max_height
         self.points = None
 
-        # Load needed data
+        # Load needed data, unless it has been passed in memory
+        self.polygon = polygon
         try:
-            self.polygon = self.load('polygon.pkl', data_file=True)
+            if self.polygon is None:
+                self.polygon = self.load_geometries('polygon')
         except FileNotFoundError:
             raise FileNotFoundError("Polygon data is missing. Please run the SVGToPolygon class first!")
 
     def random_generator(self):
         """
         Generates random points within the polygon. The number of points is determined by the num_points attribute.
-        The points are saved in the 'points.pkl' file.
+        The points are uniformly distributed over the polygon area and are saved in the 'points.npy' file.
 
         Returns
         -------
-        list
-            A list of generated points.
+        numpy.ndarray
+            A (N, 2) array of generated points.
         """
 
         self._clean_data()
-        
-        minx, miny, maxx, maxy = self.polygon.bounds
+
         # Create a tqdm object with a total
         description = "Generating seed points"
         description += " " * (26 - len(description))
         pbar = tqdm(total=self.num_points, desc=description, unit=" seed point(s)")
-        minx, miny, maxx, maxy = self.polygon.bounds
-        self.points = []
-        while len(self.points) < self.num_points:
-            pnt = Point(np.random.uniform(minx, maxx), np.random.uniform(miny, maxy))
-            if self.polygon.contains(pnt):
-                self.points.append((pnt.x, pnt.y))  # Append as tuple
-                pbar.update(1)
-            
+
+        points = self._sample_triangulation(self.num_points)
+        self.points = points
+        pbar.update(self.num_points)
+        pbar.close()
+
         # Save the data and return the points
-        self.save(self.points, 'points.pkl', data_file=True)
+        self.save_points(self.points)
         return self.points
+
+    def _sample_triangulation(self, num_points):
+        """
+        Draws points uniformly distributed within the polygon, without rejection.
+
+        The polygon is triangulated once (constrained Delaunay triangulation,
+        which respects holes and the boundaries of each part), once cleaned like
+        in VoronoiFiller.process, triangles are drawn
+        with a probability proportional to their area and a point is drawn
+        uniformly within each drawn triangle.
+
+        Parameters
+        ----------
+        num_points : int
+            The number of points to draw.
+
+        Returns
+        -------
+        numpy.ndarray
+            A (num_points, 2) array of points.
+        """
+        # Clean the polygon as VoronoiFiller does: self-intersecting rings cannot be triangulated, and overlapping
+        # parts would be counted twice
+        cleaned_polygon = self.polygon.buffer(0)
+        triangles = shapely.get_parts(shapely.constrained_delaunay_triangles(cleaned_polygon))
+        areas = shapely.area(triangles)
+        vertices = shapely.get_coordinates(shapely.get_exterior_ring(triangles)).reshape(-1, 4, 2)[:, :3]
+
+        # Pick a triangle for each point, weighted by area
+        picked = self.rng.choice(len(triangles), size=num_points, p=areas / areas.sum())
+        a, b, c = vertices[picked, 0], vertices[picked, 1], vertices[picked, 2]
+
+        # Uniform barycentric coordinates: points drawn in the other half of the parallelogram are folded back
+        u, v = self.rng.random((2, num_points))
+        folded = u + v > 1
+        u[folded], v[folded] = 1 - u[folded], 1 - v[folded]
+        return a + u[:, np.newaxis] * (b - a) + v[:, np.newaxis] * (c - a)
     
     def grid_generator(self):
         """
         Generates a grid of points within the polygon. The grid parameters are determined by the nx, ny, rand_offset_x, 
-        rand_offset_y, rand_step_x, rand_step_y, and angle attributes. The points are saved in the 'points.pkl' file.
+        rand_offset_y, rand_step_x, rand_step_y, and angle attributes. Points falling outside the polygon are dropped.
+        The points are saved in the 'points.npy' file.
 
         Returns
         -------
-        list
-            A list of generated points.
+        numpy.ndarray
+            A (N, 2) array of generated points.
         """
         
         self._clean_data()
@@ -173,7 +215,7 @@ class PointsGenerator(DataProcessorBaseClass):
         # Create a tqdm object with a total
         description = "Generating points"
         description += " " * (26 - len(description))
-        pbar = tqdm(total=5, desc=description, unit=" seed point(s)")
+        pbar = tqdm(total=6, desc=description, unit=" seed point(s)")
         minx, miny, maxx, maxy = self.polygon.bounds
 
         # Define the number of points in the x and y directions
@@ -183,14 +225,14 @@ class PointsGenerator(DataProcessorBaseClass):
         pbar.update(1)
         
         # Generate points with a smaller random offset for each coordinate
-        self.points = [(xi + (np.random.rand() - self.rand_offset_x) * (maxx - minx) / (nx * self.rand_step_x), 
-                   yi + (np.random.rand() - self.rand_offset_y) * (maxy - miny) / (ny * self.rand_step_y)) 
-                  for xi in x for yi in y]
+        points = np.stack(np.meshgrid(x, y, indexing='ij'), axis=-1).reshape(-1, 2)
+        offsets = self.rng.random((len(points), 2)) - (self.rand_offset_x, self.rand_offset_y)
+        points += offsets * ((maxx - minx) / (nx * self.rand_step_x), (maxy - miny) / (ny * self.rand_step_y))
         pbar.update(1)
             
         # If angle is not provided, generate a random rotation angle
         if self.angle is None:
-            self.angle = np.random.rand() * 2 * np.pi
+            self.angle = self.rng.random() * 2 * np.pi
 
         # Rotation matrix
         rotation_matrix = np.array([[np.cos(self.angle), -np.sin(self.angle)], 
@@ -198,13 +240,17 @@ class PointsGenerator(DataProcessorBaseClass):
         pbar.update(1)
     
         # Calculate the center of the polygon
-        center = [self.polygon.centroid.x, self.polygon.centroid.y]
+        center = np.array([self.polygon.centroid.x, self.polygon.centroid.y])
         
-        # Apply rotation to each point around the center of the polygon
-        self.points = [np.dot(rotation_matrix, np.subtract(point, center)) + center for point in self.points]
+        # Apply rotation to all the points around the center of the polygon
+        points = (points - center) @ rotation_matrix.T + center
+        pbar.update(1)
+
+        # Keep the points inside the polygon
+        self.points = self._filter_points(points, 'grid', 'nx, ny, rand_offset_x, rand_offset_y, rand_step_x and rand_step_y')
         pbar.update(1)
         
-        self.save(self.points, 'points.pkl', data_file=True)
+        self.save_points(self.points)
         pbar.update(1)
         pbar.close()
         return self.points
@@ -212,65 +258,71 @@ class PointsGenerator(DataProcessorBaseClass):
     def rectangle_generator(self):
         """
         Generates points within randomly placed rectangles within the polygon. The rectangle parameters are determined by 
-        the num_rectangles, min_width, max_width, min_height, and max_height attributes. The points are saved in the 'points.pkl' file.
+        the num_rectangles, min_width, max_width, min_height, and max_height attributes. Points falling outside the 
+        polygon are dropped. The points are saved in the 'points.npy' file.
 
         Returns
         -------
-        list
-            A list of generated points.
+        numpy.ndarray
+            A (N, 2) array of generated points.
         """
         self._clean_data()
         minx, miny, maxx, maxy = self.polygon.bounds
-        self.points = []
   
         description = "Generating points"
         description += " " * (26 - len(description))
-        
-        for _ in tqdm(range(self.num_rectangles), desc=description, unit=" seed point(s)"):
-            # Choose a random location for the bottom left corner of the rectangle
-            x0 = np.random.uniform(minx, maxx)
-            y0 = np.random.uniform(miny, maxy)
+        pbar = tqdm(total=self.num_rectangles, desc=description, unit=" seed point(s)")
 
-            # Choose a random width and height for the rectangle
-            width = np.random.uniform(self.min_width, self.max_width)
-            height = np.random.uniform(self.min_height, self.max_height)
+        # Choose a random location for the bottom left corner of the rectangles
+        x0 = self.rng.uniform(minx, maxx, self.num_rectangles)
+        y0 = self.rng.uniform(miny, maxy, self.num_rectangles)
 
-            # Make sure the rectangle fits within the polygon bounds
-            x1 = min(x0 + width, maxx)
-            y1 = min(y0 + height, maxy)
+        # Choose a random width and height for the rectangles
+        width = self.rng.uniform(self.min_width, self.max_width, self.num_rectangles)
+        height = self.rng.uniform(self.min_height, self.max_height, self.num_rectangles)
+
+        # Make sure the rectangles fit within the polygon bounds
+        x1 = np.minimum(x0 + width, maxx)
+        y1 = np.minimum(y0 + height, maxy)
 
-            # Generate points within the rectangle
-            x = np.linspace(x0, x1, self.nx)
-            y = np.linspace(y0, y1, self.ny)
-            self.points.extend((xi, yi) for xi in x for yi in y)
+        # Generate points within the rectangles and keep the points inside the polygon
+        points = self._rectangle_points(x0, y0, x1, y1)
+        self.points = self._filter_points(points, 'rectangle', 'num_rectangles, min_width, max_width, min_height and max_height')
+        pbar.update(self.num_rectangles)
+        pbar.close()
 
         # Save the data and return the points
-        self.save(self.points, 'points.pkl', data_file=True)
+        self.save_points(self.points)
         return self.points
 
     def rectangle_tiling_generator(self):
+        """
+        Generates points within rectangles tiling the bounding box of the polygon, row by row from the bottom left
+        corner. The rectangle parameters are determined by the num_rectangles, min_width, max_width, min_height, and
+        max_height attributes. Points falling outside the polygon are dropped. The points are saved in the 'points.npy' file.
 
-        self.points = []
+        Returns
+        -------
+        numpy.ndarray
+            A (N, 2) array of generated points.
+        """
 
         description = "Generating points within rectangles..."
         minx, miny, maxx, maxy = self.polygon.bounds
 
+        # Choose a random width and height for the rectangles
+        width = self.rng.uniform(self.min_width, self.max_width, self.num_rectangles)
+        height = self.rng.uniform(self.min_height, self.max_height, self.num_rectangles)
+
+        # Place the rectangles: each one depends on the previous one, but only a few scalars are involved
+        corners = np.empty((self.num_rectangles, 4))
         x0 = minx
         y0 = miny
-
-        for _ in tqdm(range(self.num_rectangles), desc=description, unit=" seed point(s)"):
-            # Choose a random width and height for the rectangle
-            width = np.random.uniform(self.min_width, self.max_width)
-            height = np.random.uniform(self.min_height, self.max_height)
-
+        for i in tqdm(range(self.num_rectangles), desc=description, unit=" seed point(s)"):
             # Make sure the rectangle fits within the polygon bounds
-            x1 = min(x0 + width, maxx)
-            y1 = min(y0 + height, maxy)
-
-            # Generate points within the rectangle
-            x = np.linspace(x0, x1, self.nx)
-            y = np.linspace(y0, y1, self.ny)
-            self.points.extend((xi, yi) for xi in x for yi in y)
+            x1 = min(x0 + width[i], maxx)
+            y1 = min(y0 + height[i], maxy)
+            corners[i] = (x0, y0, x1, y1)
 
             # Move to the next rectangle position
             x0 = x1
@@ -278,17 +330,73 @@ class PointsGenerator(DataProcessorBaseClass):
                 x0 = minx
                 y0 = y1
 
+        # Generate points within the rectangles and keep the points inside the polygon
+        points = self._rectangle_points(*corners.T)
+        self.points = self._filter_points(points, 'rectangle', 'num_rectangles, min_width, max_width, min_height and max_height')
+
         # Save the data and return the points
-        self.save(self.points, 'points.pkl', data_file=True)
+        self.save_points(self.points)
         return self.points
 
+    def _rectangle_points(self, x0, y0, x1, y1):
+        """
+        Generates a grid of nx by ny points within each rectangle, all at once.
+
+        Parameters
+        ----------
+        x0, y0, x1, y1 : numpy.ndarray
+            The corners of the rectangles.
+
+        Returns
+        -------
+        numpy.ndarray
+            A (num_rectangles * nx * ny, 2) array of points, rectangle by rectangle.
+        """
+        # Same points as np.linspace(x0, x1, nx) and np.linspace(y0, y1, ny) for each rectangle
+        x = x0[:, np.newaxis] + (x1 - x0)[:, np.newaxis] * np.linspace(0, 1, self.nx)
+        y = y0[:, np.newaxis] + (y1 - y0)[:, np.newaxis] * np.linspace(0, 1, self.ny)
+        points = np.empty((len(x0), self.nx, self.ny, 2))
+        points[..., 0] = x[:, :, np.newaxis]
+        points[..., 1] = y[:, np.newaxis, :]
+        return points.reshape(-1, 2)
+
+    def _filter_points(self, points, generator, settings):
+        """
+        Keeps the points that lie within the polygon, tested in one batch.
+
+        Parameters
+        ----------
+        points : numpy.ndarray
+            A (N, 2) array of points.
+        generator : str
+            The name of the generator in the configuration file, for the error message.
+        settings : str
+            The settings of the generator that set the number and the spread of the points, for the error message.
+
+        Returns
+        -------
+        numpy.ndarray
+            The points inside the polygon.
+
+        Raises
+        ------
+        ValueError
+            If less than MIN_POINTS points lie within the polygon: the Voronoi diagram cannot be built from them.
+        """
+        shapely.prepare(self.polygon)
+        inside = points[shapely.contains_xy(self.polygon, points[:, 0], points[:, 1])]
+        if len(inside) < self.MIN_POINTS:
+            raise ValueError(f"Only {len(inside)} of the {len(points)} points of the {generator} generator lie within the main polygon, "
+                             f"at least {self.MIN_POINTS} are needed. Adjust point_generators.{generator} in the configuration file: {settings}.")
+        return inside
+
     def _clean_data(self):
         """
-        Deletes 'voronoi.pkl' and 'colored.pkl' files if they exist. This method is called before generating a new set of points.
+        Deletes the voronoi and colored geometry artifacts and the 'adjacency.pkl' file if they exist. This method is called before generating a new set of points.
         """
-        # we generate a new set of points, so we need to delete voronoi.pkl and colored.pkl
-        if os.path.exists(self.save_data_path + 'voronoi.pkl'):
-            os.remove(self.save_data_path + 'voronoi.pkl')
-        if os.path.exists(self.save_data_path + 'colored.pkl'):
-            os.remove(self.save_data_path + 'colored.pkl')
+        # we generate a new set of points, so we need to delete the voronoi and colored polygons and adjacency.pkl
+        self.remove_geometries('voronoi')
+        if os.path.exists(self.save_data_path + 'adjacency.pkl'):
+            os.remove(self.save_data_path + 'adjacency.pkl')
+        self.remove_geometries('colored')
 
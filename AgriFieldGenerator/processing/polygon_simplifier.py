@@ -0,0 +1,112 @@
+# Copyright (c) [2024] [Didier ALAIN]
+# Repository: https://github.com/Tanin69/AgriFieldGenerator
+#
+# The project makes it possible to generate patterns of large cultivated fields
+# reproducing as believable as possible the diversity of agricultural
+# landscapes. It allows you to generate texture masks that can be used in the
+# world editor of the Enfusion Workbench.
+#
+# It is released under the MIT License. Please see the LICENSE file for details.
+#
+# Enfusion is a game engine developed by Bohemia Interactive for the Arma game series
+# The Enfusion Workbench is a creation workbench dedicated to the Enfusion engine.
+#
+
+import shapely
+from shapely.geometry import MultiPolygon
+
+from .data_processor_base_class import DataProcessorBaseClass
+
+class PolygonSimplifier(DataProcessorBaseClass):
+    """
+    A class used to simplify the main polygon before it is filled with the Voronoi diagram.
+
+    The flattened splines give the main polygon very dense rings, and every later
+    stage pays for their vertices. The vertices that are closer than a tolerance
+    of a pixel or so to the simplified rings are removed, which does not change
+    the masks, while the topology is preserved: the rings stay valid and do not
+    cross each other.
+
+    Attributes
+    ----------
+    All the attributes from DataProcessorBaseClass and the following. All values
+    are read from the configuration file, except polygon and the vertex counts.
+
+    tolerance : float
+        The maximum distance, in pixels, between the main polygon and its simplified version.
+    polygon : MultiPolygon
+        The main polygon, simplified once process() has run.
+    num_vertices : int
+        The number of vertices of the main polygon before simplification.
+    num_simplified_vertices : int
+        The number of vertices of the simplified main polygon.
+
+    Methods
+    -------
+    process():
+        Simplifies the main polygon.
+    statistics():
+        Returns the tolerance and the vertex counts of the simplification.
+    """
+
+    def __init__(self, source_path, save_path, save_data_path, svg_path, svg_height, svg_width, tolerance, artifact_format='columnar', polygon=None, checkpoint=True):
+        """
+        Constructs all the necessary attributes for the PolygonSimplifier object.
+
+        Parameters
+        ----------
+        tolerance : float
+            The maximum distance, in pixels, between the main polygon and its simplified version.
+        artifact_format : str, optional
+            The format of the saved polygon, 'columnar' or 'pickle' (default is 'columnar').
+        polygon : MultiPolygon, optional
+            The main polygon, if it is already in memory. Otherwise, it is loaded from the data directory.
+        checkpoint : bool, optional
+            Whether to save the simplified polygon to the data directory (default is True).
+        """
+        super().__init__(source_path=source_path, save_path=save_path, save_data_path=save_data_path, svg_path=svg_path, svg_height=svg_height, svg_width=svg_width, artifact_format=artifact_format, checkpoint=checkpoint)
+        self.tolerance = tolerance
+        self.num_vertices = None
+        self.num_simplified_vertices = None
+
+        # Load needed data, unless it has been passed in memory
+        self.polygon = polygon
+        try:
+            if self.polygon is None:
+                self.polygon = self.load_geometries('polygon')
+        except FileNotFoundError:
+            raise FileNotFoundError("Polygon data is missing. Please run the SVGToPolygon class first!")
+
+    def process(self):
+        """
+        Simplifies the main polygon, preserving its topology, and saves it in place of the original one.
+
+        Returns
+        -------
+        MultiPolygon
+            The simplified main polygon.
+        """
+        self.num_vertices = int(shapely.get_num_coordinates(self.polygon))
+        simplified = shapely.simplify(self.polygon, self.tolerance, preserve_topology=True)
+        if not isinstance(simplified, MultiPolygon):
+            simplified = MultiPolygon([simplified])
+        self.polygon = simplified
+        self.num_simplified_vertices = int(shapely.get_num_coordinates(self.polygon))
+
+        reduction = 100 * (1 - self.num_simplified_vertices / self.num_vertices) if self.num_vertices else 0
+        print(f"Main polygon simplified from {self.num_vertices} to {self.num_simplified_vertices} vertices ({reduction:.0f}% fewer).")
+
+        # Save the data, with the vertex counts so that the reduction can be checked later, and return the simplified polygon
+        self.save_geometries(self.polygon, 'polygon', meta={'simplification': self.statistics()})
+        return self.polygon
+
+    def statistics(self):
+        """
+        Returns the tolerance and the vertex counts of the simplification.
+
+        Returns
+        -------
+        dict
+            The 'tolerance', 'num_vertices' and 'num_simplified_vertices' of the simplification.
+        """
+        return {'tolerance': self.tolerance, 'num_vertices': self.num_vertices, 'num_simplified_vertices': self.num_simplified_vertices}
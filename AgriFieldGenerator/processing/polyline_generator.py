@@ -1,21 +1,30 @@
-import random
-
-import cv2
 import numpy as np
-from PIL import Image
-import pickle
-from shapely.geometry import Polygon
+
+from .geometry_store import GeometryStore
+
+# A polyline entity in Enfusion format, with its origin point, and each of its other points relative to the origin
+POLYLINE_HEADER = 'PolylineShapeEntity {\n coords %r 0 %r\n Points {\n  ShapePoint "{%016X}" {\n   Position 0 0 0\n  }'
+POLYLINE_POINT = '\n  ShapePoint "{%016X}" {\n   Position %r 0 %r\n  }'
+POLYLINE_FOOTER = '\n }\n}'
 
 class PolylineGenerator:
-    def __init__(self, surface_map_resolution, save_path, save_data_path):
+    # The number of ShapePoint IDs drawn at once
+    ID_BATCH_SIZE = 65536
+
+    def __init__(self, surface_map_resolution, save_path, save_data_path, colored_polygons=None, seed=None):
         self.surface_map_resolution = surface_map_resolution
         self.save_path = save_path
         self.save_data_path = save_data_path
-        self.colored_polygon = save_data_path + 'colored.pkl'
+        self.geometry_store = GeometryStore(save_data_path)
+        self.colored_polygons = colored_polygons
+        self.rng = np.random.default_rng(seed)
+        self._ids = []
+        self._next_id = 0
 
     def generate_polylines(self):
         """
-        Generates a polyline for the border of a colored polygon.
+        Generates a polyline for the border of each colored polygon, and writes them to the
+        'polylines_colored.layer' file as they are generated.
 
         Parameters
         ----------
@@ -23,94 +32,53 @@ class PolylineGenerator:
 
         Returns
         -------
-        polyline : Polyline
-            The generated polyline.
+        int
+            The number of generated polylines.
         """
 
-        with open(self.colored_polygon, 'rb') as f:
-            self.polygon = pickle.load(f)
+        # Use the colored polygons passed in memory, if any
+        self.polygon = self.colored_polygons if self.colored_polygons is not None else self.geometry_store.load('colored')
         
-        polylines = []
         # We need to define an offset because of the surface resolution in Enfusion: terrain coordinates and surface mask coordinates are not the same
         offset = self.surface_map_resolution
         
-        for poly in self.polygon:
-            x, y = poly.polygon.exterior.xy
-            coords = list(zip(x, y))
-            poly = Polygon(coords).buffer(-2) # We strip the polygon to avoid polylines overlapping
-            origin = (x[0] * offset, 0, y[0] * offset)
-            relative_points = [((x[i] * offset) - origin[0], 0, (y[i] * offset) - (origin[2])) for i in range(1, len(x))]
-            polyline = self._generate_enfusion_polyline(origin, relative_points)
-            polylines.append(polyline)
-
-        # Save the polylines to a file
+        num_polylines = 0
         with open(self.save_path + 'polylines_colored.layer', 'w') as f:
-            f.write('\n'.join(polylines))
-
-        print(f"Generated {len(polylines)} Enfusion polylines for colored polygons.\n(see {self.save_path} polylines_colored.layer file).")
+            for poly in self.polygon:
+                points = np.asarray(poly.polygon.exterior.coords) * offset
+                if num_polylines:
+                    f.write('\n')
+                f.write(self._generate_enfusion_polyline(points[0], points[1:] - points[0]))
+                num_polylines += 1
+
+        print(f"Generated {num_polylines} Enfusion polylines for colored polygons.\n(see {self.save_path} polylines_colored.layer file).")
      
-        return polylines
+        return num_polylines
     
     def _generate_enfusion_polyline(self, origin, points):
         """
-        Generate a polyline entity in Enfusion format.
-        :param origin: The origin point coordinates as a tuple (x, y, z).
-        :param points: A list of point coordinates relative to the origin, each as a tuple (x, y, z).
+        Generate a polyline entity in Enfusion format. All its points are formatted in one operation.
+        :param origin: The (x, z) coordinates of the origin point.
+        :param points: The (N, 2) array of the (x, z) coordinates of the other points, relative to the origin.
         :return: A string representing the polyline entity in Enfusion format.
         """
-        entity = []
-
-        # Add the PolylineShapeEntity with origin coords
-        entity.append('PolylineShapeEntity {')
-        entity.append(' coords {0} {1} {2}'.format(*origin))
-
-        entity.append(' Points {')
-
-        # Add the origin point
-        entity.append('  ShapePoint "{0}" {{'.format(self._generate_random_id()))
-        entity.append('   Position 0 0 0')
-        entity.append('  }')
-
-        # Add the relative points
-        for point in points:
-            entity.append('  ShapePoint "{0}" {{'.format(self._generate_random_id()))
-            entity.append('   Position {0} {1} {2}'.format(*point))
-            entity.append('  }')
-
-        entity.append(' }')
-        entity.append('}')
-
-        # Join the entity lines into a single string
-        entity_str = '\n'.join(entity)
-
-        return entity_str
-
-    def _generate_random_id(self):
+        ids = self._generate_random_ids(len(points) + 1)
+        # The ID, x and z of each point, one point after the other
+        values = np.empty((len(points), 3), dtype=object)
+        values[:, 0] = ids[1:]
+        values[:, 1:] = points.tolist()
+        return (POLYLINE_HEADER % (*origin.tolist(), ids[0])
+                + POLYLINE_POINT * len(points) % tuple(values.ravel().tolist())
+                + POLYLINE_FOOTER)
+
+    def _generate_random_ids(self, count):
         """
-        Generate a random ID for a ShapePoint.
-        :return: A random ID as a string.
+        Generate random IDs for ShapePoints. They are drawn in batches of at least ID_BATCH_SIZE IDs.
+        :param count: The number of IDs.
+        :return: The list of the IDs, as integers.
         """
-        return "{%016X}" % random.randint(0, 2**64-1)
-
-        img = Image.open(self.image_path)
-        data = np.array(img)
-        x_offset = 28
-        y_offset = 28 # Sort of magic value ;-)
-        enfusion_polylines = []
-
-        black_color = (0, 0, 0)  # RGB for black
-        mask = np.all(data[:, :, :3] == black_color, axis=-1)  # Only use the first three channels (RGB)
-
-        contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        polylines = [cv2.approxPolyDP(contour, 1, False) for contour in contours]
-
-        for polyline in polylines:
-            origin = (polyline[0][0][0] + x_offset, 0, (self.svg_height - polyline[0][0][1]) + y_offset)  # Add z coordinate
-            points = [(point[0][0] - (origin[0] - x_offset), 0, (self.svg_height - point[0][1])- (origin[2] - y_offset)) for point in polyline[1:]]  # Add z coordinate
-            enfusion_polyline = self.enfusion_utils.generate_enfusion_polyline(origin, points)
-            enfusion_polylines.append(enfusion_polyline)
-
-        with open(self.save_path + 'polylines_cv2.layer', 'w') as f:
-            f.write('\n'.join(enfusion_polylines))
-
-        return enfusion_polylines
\ No newline at end of file
+        if len(self._ids) - self._next_id < count:
+            self._ids = self.rng.integers(0, 2**64, size=max(count, self.ID_BATCH_SIZE), dtype=np.uint64).tolist()
+            self._next_id = 0
+        self._next_id += count
+        return self._ids[self._next_id - count:self._next_id]
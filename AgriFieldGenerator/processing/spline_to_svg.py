@@ -1,11 +1,12 @@
-import re
-
-from collections import OrderedDict
 import numpy as np
-import svgwrite
 
 from .data_processor_base_class import DataProcessorBaseClass
 
+# The SVG file, with its height and width, and each of its paths
+SVG_HEADER = ('<?xml version="1.0" encoding="utf-8" ?>\n<svg baseProfile="tiny" height="%d" version="1.2" width="%d" xmlns="http://www.w3.org/2000/svg" '
+              'xmlns:ev="http://www.w3.org/2001/xml-events" xmlns:xlink="http://www.w3.org/1999/xlink"><defs />')
+SVG_PATH = '<path d="%s" fill="none" stroke="black" />'
+
 class SplineToSVG(DataProcessorBaseClass):
     def __init__(self, source_path, save_path, save_data_path, svg_path, svg_height, svg_width, surface_map_resolution, enfusion_spline_layer_file):
         super().__init__(source_path=source_path, save_path=save_path, save_data_path=save_data_path, svg_path=svg_path, svg_height=svg_height, svg_width=svg_width)
@@ -15,86 +16,99 @@ class SplineToSVG(DataProcessorBaseClass):
         self.surface_map_resolution = surface_map_resolution
     
     def parse_spline_file(self):
+        """
+        Reads the Enfusion layer file line by line, and yields its splines one at a time, so that only one
+        spline is held in memory.
+
+        Each spline is a dict with the (N, 3) arrays 'positions', 'in_tangents' and 'out_tangents' of its
+        points, in absolute coordinates, and its 'is_closed' flag. The origin of the spline (its coords) is
+        not one of its points. As in the Enfusion files, the in tangent of a point is its OutTangent value
+        and its out tangent is its InTangent value. A point without Data has null tangents.
+        """
+        spline = None
         with open(self.source_layer, 'r') as file:
-            content = file.readlines()
-        splines = []  # List to store multiple splines
-        spline = {"points": []}
-        points = []
-        current_point = OrderedDict()
-        origin = np.array([0, 0, 0])  # Store the origin point
-        for i, line in enumerate(content):
-            if "SplineShapeEntity" in line:
-                # If a spline already exists, add it to the list of splines
-                if points:
-                    spline['points'] = points
-                    splines.append(spline)
-                    points = []  # Reset the points list for the next spline
-                # Initialize a new spline
-                spline = {"points": [], "is_closed": 0}  # Default to not closed
-            elif "IsClosed" in line:
-                # Extract the IsClosed value
-                is_closed = int(re.search(r'\d+', line).group())
-                spline["is_closed"] = is_closed
-            elif "coords" in line:
-            # Extract the origin point coordinates
-                origin_data = np.array([float(x) for x in re.findall(r"[-+]?\d*\.\d+|[-+]?\d+", line)])
-                current_point["position"] = (origin_data).tolist()
-                origin = np.array(origin_data)
-                points.append(dict(current_point))
-                current_point.clear()
-            elif "Position" in line:
-                # Extract the point coordinates
-                position_data = [float(x) for x in re.findall(r"[-+]?\d*\.\d+|[-+]?\d+", line)]
-                relative_position = np.array(position_data)
-                # Convert to absolute coordinates by adding the origin
-                absolute_position = (origin + relative_position)
-                current_point["position"] = absolute_position.tolist()
-                # Initialize in_tangent and out_tangent with current position if the next line does not contain 'Data'
-                if i+1 < len(content) and "Data" not in content[i+1]:
-                    current_point["in_tangent"] = [0, 0, 0]
-                    current_point["out_tangent"] = [0, 0, 0]
-            elif "InTangent" in line:
-                relative_in_tangent = np.array([float(x) for x in re.findall(r"[-+]?\d*\.\d+|[-+]?\d+", line)])
-                current_point["out_tangent"] = relative_in_tangent.tolist()
-            elif "OutTangent" in line:
-                relative_out_tangent = np.array([float(x) for x in re.findall(r"[-+]?\d*\.\d+|[-+]?\d+", line)])
-                current_point["in_tangent"] = relative_out_tangent.tolist()
-            # Add the current point to the list of points only if it has 'position', 'in_tangent' and 'out_tangent'
-            if "position" in current_point and "in_tangent" in current_point and "out_tangent" in current_point:
-                points.append(dict(current_point))
-                current_point.clear()  # Reset the current point for the next one
-        # Add the last spline to the list of splines
-        if points:
-            spline['points'] = points
-            splines.append(spline)
-        return splines
+            for line in file:
+                # A line is a keyword followed by its values
+                tokens = line.split()
+                if not tokens:
+                    continue
+                keyword = tokens[0]
+                if keyword == 'SplineShapeEntity':
+                    if spline is not None and spline['points']:
+                        yield self._pack_spline(spline)
+                    spline = {'origin': [0.0, 0.0, 0.0], 'is_closed': 0, 'points': []}
+                elif spline is None:
+                    continue
+                elif keyword == 'Position':
+                    # The position, the in tangent and the out tangent of the point, one after the other
+                    origin = spline['origin']
+                    spline['points'].extend((origin[0] + float(tokens[1]), origin[1] + float(tokens[2]), origin[2] + float(tokens[3]), 0.0, 0.0, 0.0, 0.0, 0.0, 0.0))
+                elif keyword == 'OutTangent' and spline['points']:
+                    spline['points'][-6:-3] = map(float, tokens[1:4])
+                elif keyword == 'InTangent' and spline['points']:
+                    spline['points'][-3:] = map(float, tokens[1:4])
+                elif keyword == 'coords':
+                    spline['origin'] = [float(x) for x in tokens[1:4]]
+                elif keyword == 'IsClosed':
+                    spline['is_closed'] = int(tokens[1])
+        if spline is not None and spline['points']:
+            yield self._pack_spline(spline)
 
-    def hermite_to_bezier(self, splines):
-        
-        dwg = svgwrite.Drawing(self.svg_path , profile='tiny', size=(self.svg_height, self.svg_width))      
-        for spline in splines:
-            points = spline['points'][1:]  # Exclude only the first point
-            # Because we use this svg to generate surface masks, we have to divide the spline coordinates by the surface map resolution
-            # to have the right scale betwwen map resolution and surface map resolution
-            origin_coords = points[0]['position'][0] / self.surface_map_resolution, self.svg_height - (points[0]['position'][2] / self.surface_map_resolution)
-            path = dwg.path(d=("M", origin_coords), fill='none', stroke='black')
-            for i in range(len(points) - 1):
-                p0 = [points[i]['position'][0] / self.surface_map_resolution, self.svg_height - (points[i]['position'][2] / self.surface_map_resolution)] 
-                p1 = [p0[0] + points[i].get('in_tangent', [0, 0, 0])[0] / 3, p0[1] - points[i].get('in_tangent', [0, 0, 0])[2] / 3]
-                p3 = [points[i+1]['position'][0] / self.surface_map_resolution, self.svg_height - (points[i+1]['position'][2] / self.surface_map_resolution)]
-                p2 = [p3[0] - points[i+1].get('out_tangent', [0, 0, 0])[0] / 3, p3[1] + points[i+1].get('out_tangent', [0, 0, 0])[2] / 3]
-                path.push("C", p1[0], p1[1], p2[0], p2[1], p3[0], p3[1])
+    def _pack_spline(self, spline):
+        points = np.array(spline['points'], dtype=np.float64).reshape(-1, 3, 3)
+        return {'positions': points[:, 0], 'in_tangents': points[:, 1], 'out_tangents': points[:, 2], 'is_closed': spline['is_closed']}
 
-            # If the spline is closed, add a line from the last point to the first
-            if spline["is_closed"]:
-                p0 = [points[-1]['position'][0] / self.surface_map_resolution, self.svg_height - (points[-1]['position'][2] / self.surface_map_resolution)] 
-                p3 = [points[0]['position'][0] / self.surface_map_resolution, self.svg_height - (points[0]['position'][2] / self.surface_map_resolution)]
-                path.push("L", p3[0], p3[1])
+    def bezier_control_points(self, spline):
+        """
+        Converts the Hermite segments of a spline into cubic Bezier segments, in SVG coordinates, all at once.
+        The control points of the segment from p0 to p3 are p0 + t0 / 3 and p3 - t3 / 3, where t0 is the in
+        tangent of p0 and t3 the out tangent of p3.
 
-            dwg.add(path)
+        Returns
+        -------
+        tuple
+            The (N, 2) array of the points of the spline, and the (N - 1, 3, 2) array of the control points
+            and end point of each segment.
+        """
+        # Because we use this svg to generate surface masks, we have to divide the spline coordinates by the surface map resolution
+        # to have the right scale betwwen map resolution and surface map resolution
+        positions = np.column_stack([spline['positions'][:, 0] / self.surface_map_resolution, self.svg_height - spline['positions'][:, 2] / self.surface_map_resolution])
+        # The y axis of the SVG runs in the opposite direction to the z axis of the world
+        in_tangents = np.column_stack([spline['in_tangents'][:, 0] / 3, -(spline['in_tangents'][:, 2] / 3)])
+        out_tangents = np.column_stack([spline['out_tangents'][:, 0] / 3, -(spline['out_tangents'][:, 2] / 3)])
+        segments = np.stack([positions[:-1] + in_tangents[:-1], positions[1:] - out_tangents[1:], positions[1:]], axis=1)
+        return positions, segments
 
-        dwg.save()
-        print(f"SVG file saved to {self.svg_path}")
-        return self.svg_path
+    def bezier_paths(self, splines):
+        """
+        Converts the splines into cubic Bezier paths, in SVG coordinates, one at a time.
+
+        Yields
+        ------
+        tuple
+            The points of the spline, the control points and end point of its segments (see
+            bezier_control_points), and whether it is closed.
+        """
+        for spline in splines:
+            positions, segments = self.bezier_control_points(spline)
+            yield positions, segments, spline["is_closed"]
 
+    def hermite_to_bezier(self, splines):
+        """
+        Writes the splines to the SVG file as cubic Bezier paths. The path data of each spline is formatted in
+        one operation and written as soon as the spline is converted.
+        """
+        with open(self.svg_path, 'w', encoding='utf-8') as svg_file:
+            svg_file.write(SVG_HEADER % (self.svg_width, self.svg_height))
+            for positions, segments, is_closed in self.bezier_paths(splines):
+                path_format = 'M %r %r' + ' C %r %r %r %r %r %r' * len(segments)
+                values = positions[0].tolist() + segments.ravel().tolist()
+                # If the spline is closed, add a line from the last point to the first
+                if is_closed:
+                    path_format += ' L %r %r'
+                    values += positions[0].tolist()
+                svg_file.write(SVG_PATH % (path_format % tuple(values)))
+            svg_file.write('</svg>')
 
+        print(f"SVG file saved to {self.svg_path}")
+        return self.svg_path
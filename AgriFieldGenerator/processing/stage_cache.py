@@ -0,0 +1,224 @@
+# Copyright (c) [2024] [Didier ALAIN]
+# Repository: https://github.com/Tanin69/AgriFieldGenerator
+#
+# The project makes it possible to generate patterns of large cultivated fields
+# reproducing as believable as possible the diversity of agricultural
+# landscapes. It allows you to generate texture masks that can be used in the
+# world editor of the Enfusion Workbench.
+#
+# It is released under the MIT License. Please see the LICENSE file for details.
+#
+# Enfusion is a game engine developed by Bohemia Interactive for the Arma game series
+# The Enfusion Workbench is a creation workbench dedicated to the Enfusion engine.
+#
+
+import hashlib
+import json
+import os
+
+class StageCache:
+    """
+    A content-addressed cache of the pipeline stages, used to skip the stages
+    whose result would not change.
+
+    The key of a stage is the hash of its name, of the part of the configuration
+    it depends on and of the content of its input files. After a stage has run,
+    its key and its output files are recorded in the manifest. The next time,
+    the stage is skipped if its key is the same and all its outputs still exist
+    with the same content.
+    Since the inputs of a stage are the outputs of the previous ones, a change
+    only reruns the stages that depend on it: a palette change reruns the
+    colorer and the masks, but not the SVG, the polygon, the points and the
+    Voronoi diagram.
+
+    File hashes are stored in the manifest with the size and modification time
+    of the file, so that a file is only hashed again when it has changed.
+
+    Attributes
+    ----------
+    manifest_path : str
+        The path of the manifest file.
+    enabled : bool
+        Whether stages can be skipped. When False, every stage runs, but the
+        manifest is still updated.
+    manifest : dict
+        The content of the manifest.
+
+    Methods
+    -------
+    run(name, function, config, inputs, outputs)
+        Runs a stage, unless its cached result is up to date.
+    is_fresh(name, key, outputs)
+        Checks whether the recorded result of a stage is up to date.
+    stage_key(name, config, inputs)
+        Computes the key of a stage.
+    file_hash(path)
+        Computes the hash of the content of a file or of a directory.
+    """
+    VERSION = 1
+
+    def __init__(self, save_data_path, enabled=True, manifest_file='manifest.json'):
+        """
+        Constructs all the necessary attributes for the StageCache object.
+
+        Parameters
+        ----------
+        save_data_path : str
+            The path where the data files, and the manifest, are saved.
+        enabled : bool, optional
+            Whether stages can be skipped (default is True).
+        manifest_file : str, optional
+            The name of the manifest file (default is 'manifest.json').
+        """
+        self.manifest_path = save_data_path + manifest_file
+        self.enabled = enabled
+        self.manifest = {'version': self.VERSION, 'stages': {}, 'hashes': {}}
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path) as f:
+                    manifest = json.load(f)
+            except ValueError:
+                manifest = None
+            # An unreadable or outdated manifest is simply ignored: every stage runs again
+            if isinstance(manifest, dict) and manifest.get('version') == self.VERSION:
+                self.manifest = manifest
+
+    def run(self, name, function, config, inputs, outputs):
+        """
+        Runs a stage, unless its key has not changed since its last run and its outputs have not changed either.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        function : callable
+            The function running the stage.
+        config : dict
+            The configuration values the stage depends on. They must be JSON serializable.
+        inputs : list
+            The paths of the files or directories the stage reads.
+        outputs : list
+            The paths of the files or directories the stage writes.
+
+        Returns
+        -------
+        bool
+            True if the stage has run, False if it has been skipped.
+        """
+        key = self.stage_key(name, config, inputs)
+        if self.enabled and self.is_fresh(name, key, outputs):
+            print(f"{name.capitalize()} is up to date, skipping.")
+            return False
+
+        # The stage is recorded as stale until it completes, so that an interrupted run is not trusted
+        self.manifest['stages'].pop(name, None)
+        self._save()
+        function()
+        self.manifest['stages'][name] = {'key': key, 'outputs': {path: self.file_hash(path) for path in outputs}}
+        self._save()
+        return True
+
+    def is_fresh(self, name, key, outputs):
+        """
+        Checks whether the recorded result of a stage is up to date.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        key : str
+            The current key of the stage.
+        outputs : list
+            The paths of the files or directories the stage writes.
+
+        Returns
+        -------
+        bool
+            True if the stage has been recorded with the same key and the same outputs, and if they all exist
+            with the recorded content.
+        """
+        stage = self.manifest['stages'].get(name)
+        if stage is None or stage['key'] != key or sorted(stage['outputs']) != sorted(outputs):
+            return False
+        # An output rewritten since, e.g. by the stage run on its own with other settings, is not the recorded result
+        return all(os.path.exists(path) and self.file_hash(path) == stage['outputs'][path] for path in outputs)
+
+    def stage_key(self, name, config, inputs):
+        """
+        Computes the key of a stage from its name, its configuration and the content of its inputs.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        config : dict
+            The configuration values the stage depends on.
+        inputs : list
+            The paths of the files or directories the stage reads. A missing input is hashed as None.
+
+        Returns
+        -------
+        str
+            The hexadecimal SHA-256 key of the stage.
+        """
+        description = {
+            'stage': name,
+            'config': config,
+            'inputs': {path: self.file_hash(path) for path in inputs},
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def file_hash(self, path):
+        """
+        Computes the SHA-256 hash of the content of a file, or of all the files of a directory.
+        The hash is reused as long as the size and the modification time of the file do not change.
+
+        Parameters
+        ----------
+        path : str
+            The path of the file or of the directory.
+
+        Returns
+        -------
+        str
+            The hexadecimal hash, None if the path does not exist.
+        """
+        if os.path.isdir(path):
+            digest = hashlib.sha256()
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for file in sorted(files):
+                    file_path = os.path.join(root, file)
+                    digest.update(os.path.relpath(file_path, path).encode())
+                    digest.update(self.file_hash(file_path).encode())
+            return digest.hexdigest()
+        if not os.path.isfile(path):
+            return None
+
+        stat = os.stat(path)
+        fingerprint = [stat.st_size, stat.st_mtime_ns]
+        cached = self.manifest['hashes'].get(path)
+        if cached is not None and cached['fingerprint'] == fingerprint:
+            return cached['sha256']
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        self.manifest['hashes'][path] = {'fingerprint': fingerprint, 'sha256': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def _save(self):
+        """
+        Writes the manifest. It is written to a temporary file first, so that an interrupted write never
+        leaves a corrupted manifest.
+        """
+        directory = os.path.dirname(self.manifest_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # Forget the hashes of the files that have been deleted since
+        self.manifest['hashes'] = {path: cached for path, cached in self.manifest['hashes'].items() if os.path.exists(path)}
+        temporary_path = self.manifest_path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(self.manifest, f, indent=4)
+        os.replace(temporary_path, self.manifest_path)
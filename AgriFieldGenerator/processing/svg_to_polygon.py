@@ -12,14 +12,13 @@
 # The Enfusion Workbench is a creation workbench dedicated to the Enfusion engine.
 # 
 
-from xml.dom.minidom import parse
-
 import numpy as np
-from shapely.geometry import Point, Polygon, MultiPolygon
-from svg.path import parse_path, Line, CubicBezier, Move
+from shapely.geometry import Polygon, MultiPolygon
 from tqdm import tqdm
 
+from .bezier import flatten_cubic_bezier
 from .data_processor_base_class import DataProcessorBaseClass
+from .enfusion_utils import EnfusionUtils
 
 class SVGToPolygon(DataProcessorBaseClass):
     """
@@ -39,8 +38,8 @@ class SVGToPolygon(DataProcessorBaseClass):
         The width of the SVG file.
     tile_size : int
         The size of the tiles.
-    num_points : int
-        The number of points to generate for each line or curve in the SVG file.
+    tolerance : float
+        The maximum distance, in pixels, between a curve of the SVG file and its flattened polygon.
     multi_polygon : MultiPolygon
         The generated MultiPolygon object.
 
@@ -48,15 +47,15 @@ class SVGToPolygon(DataProcessorBaseClass):
     -------
     process(svg_file)
         Processes the SVG file and generates a MultiPolygon object.
+    process_splines(bezier_paths)
+        Generates the MultiPolygon object from the Bezier paths of the splines, without the SVG file.
     display()
         Displays the generated MultiPolygon object.
     get_polygon_tiles()
         Gets the tile indices for each polygon in the MultiPolygon object.
-    _get_tile_index(x, y)
-        Gets the tile index for a given point.
     """
 
-    def __init__(self, source_path, save_path, save_data_path, svg_path, svg_height, svg_width, tile_size, num_points):
+    def __init__(self, source_path, save_path, save_data_path, svg_path, svg_height, svg_width, tile_size, tolerance=0.1, artifact_format='columnar', checkpoint=True):
         """
         Constructs all the necessary attributes for the SVGToPolygon object.
 
@@ -74,10 +73,17 @@ class SVGToPolygon(DataProcessorBaseClass):
             The width of the SVG file.
         tile_size : int
             The size of the tiles.
-        num_points : int
-            The number of points to generate for each line or curve in the SVG file.
+        tolerance : float, optional
+            The maximum distance, in pixels, between a curve of the SVG file and its flattened polygon
+            (default is 0.1). The number of points of each curve is derived from it. It must be greater than 0.
+        artifact_format : str, optional
+            The format of the saved polygon, 'columnar' or 'pickle' (default is 'columnar').
+        checkpoint : bool, optional
+            Whether to save the polygon to the data directory (default is True).
         """
-        super().__init__(source_path=source_path, save_path=save_path, save_data_path=save_data_path, svg_path=svg_path, svg_height=svg_height, svg_width=svg_width)
+        if not tolerance > 0:
+            raise ValueError(f"Invalid flattening tolerance: {tolerance}. It must be greater than 0.")
+        super().__init__(source_path=source_path, save_path=save_path, save_data_path=save_data_path, svg_path=svg_path, svg_height=svg_height, svg_width=svg_width, artifact_format=artifact_format, checkpoint=checkpoint)
         self.source_path = source_path
         self.save_path = save_path
         self.save_data_path = save_data_path
@@ -85,9 +91,8 @@ class SVGToPolygon(DataProcessorBaseClass):
         self.svg_height = svg_height
         self.svg_width = svg_width
         self.tile_size=tile_size
-        self.tile_step = int(self.tile_size/20)
-        self.num_x_tiles = round(self.svg_width / self.tile_size)
-        self.num_points = num_points
+        self.enfusion_utils = EnfusionUtils(svg_height, svg_width, tile_size)
+        self.tolerance = tolerance
         self.multi_polygon = None
 
     def process(self):
@@ -113,37 +118,105 @@ class SVGToPolygon(DataProcessorBaseClass):
         if os.path.exists(self.save_data_path + 'colored.pkl'):
             os.remove(self.save_data_path + 'colored.pkl')
         """
-        dom = parse(self.svg_path)
-        path_strings = [path.getAttribute('d') for path in dom.getElementsByTagName('path')]
+        from svg.path import parse_path, Line, CubicBezier, Move
+
+        polygons = []
+        description = "Generating main polygon"
+        description += " " * (26 - len(description))
+        for path_string in tqdm(self._iter_path_data(), desc=description, unit=" path"):
+            # Gather the subpaths of the path, and flatten all its curves at once
+            subpaths = []
+            for command in parse_path(path_string):
+                if isinstance(command, Move):
+                    subpaths.append([[command.start]])
+                elif isinstance(command, Line):
+                    subpaths[-1].append([command.end])
+                elif isinstance(command, CubicBezier):
+                    subpaths[-1].append([command.start, command.control1, command.control2, command.end])
+            polygons.extend(self._flatten_subpaths(subpaths))
+
+        return self._save_polygons(polygons)
+
+    def process_splines(self, bezier_paths):
+        """
+        Generates a MultiPolygon object straight from the Bezier paths of the splines, as written to the SVG
+        file by SplineToSVG. The curves are flattened as in process, but all the segments of a path are
+        evaluated at once, and the SVG file is neither written nor parsed.
+
+        Parameters
+        ----------
+        bezier_paths : iterable
+            The (points, segments, is_closed) tuples of the paths, in SVG coordinates, as yielded by
+            SplineToSVG.bezier_paths.
+
+        Returns
+        -------
+        MultiPolygon
+            The generated MultiPolygon object.
+        """
         polygons = []
         description = "Generating main polygon"
         description += " " * (26 - len(description))
-        for path_string in tqdm(path_strings, desc=description, unit=" path"):
-            path = parse_path(path_string)
-            points = []
-            for command in path:
-                if isinstance(command, Line) or isinstance(command, CubicBezier):
-                    if isinstance(command, Line):
-                        points.append((command.end.real, self.svg_height - command.end.imag))
-                    else:  # CubicBezier
-                        for t in np.linspace(0, 1, num=self.num_points):
-                            point = command.point(t)
-                            points.append((point.real, self.svg_height - point.imag))
-                elif isinstance(command, Move):
-                    if points and len(points) >= 4:  # Ensure there are at least 4 points
-                        polygons.append(Polygon(points))
-                        points = []  # Start a new polygon
-                    points.append((command.start.real, self.svg_height - command.start.imag))
-
-            if points and len(points) >= 4:  # Add the last polygon if it has at least 4 points
+        for positions, segments, is_closed in tqdm(bezier_paths, desc=description, unit=" path"):
+            control_points = np.concatenate([positions[:-1, None, :], segments], axis=1)
+            points, _ = flatten_cubic_bezier(control_points, self.tolerance)
+            parts = [positions[:1], points]
+            if is_closed:
+                parts.append(positions[:1])
+            polygons.extend(self._to_polygons([np.concatenate(parts)]))
+
+        return self._save_polygons(polygons)
+
+    def _iter_path_data(self):
+        """
+        Reads the SVG file as a stream, and yields the data of its paths one at a time. The elements are freed
+        once read, so that the document is never held in memory.
+        """
+        from xml.etree.ElementTree import iterparse
+
+        root = None
+        for event, element in iterparse(self.svg_path, events=('start', 'end')):
+            if root is None:
+                root = element
+            if event == 'end' and element.tag.rpartition('}')[2] == 'path':
+                yield element.get('d', '')
+                element.clear()
+                root.clear()
+
+    def _flatten_subpaths(self, subpaths):
+        """
+        Flattens the subpaths of an SVG path into polygons. A subpath is a list of commands, each one the list of
+        its points as complex numbers: the start point, the end point of a line, or the 4 control points of a
+        cubic curve. All the curves are flattened in one batch.
+        """
+        curves = [command for subpath in subpaths for command in subpath[1:] if len(command) == 4]
+        control_points = np.array([[(point.real, point.imag) for point in curve] for curve in curves]).reshape(-1, 4, 2)
+        points, counts = flatten_cubic_bezier(control_points, self.tolerance)
+        curve_points = iter(np.split(points, np.cumsum(counts)[:-1]))
+
+        rings = []
+        for subpath in subpaths:
+            parts = [next(curve_points) if len(command) == 4 else np.array([[command[-1].real, command[-1].imag]]) for command in subpath]
+            rings.append(np.concatenate(parts))
+        return self._to_polygons(rings)
+
+    def _to_polygons(self, rings):
+        """
+        Converts rings of SVG points into polygons, flipping their y axis. Rings with less than 4 points are dropped.
+        """
+        polygons = []
+        for points in rings:
+            if len(points) >= 4:  # Ensure there are at least 4 points
+                points[:, 1] = self.svg_height - points[:, 1]
                 polygons.append(Polygon(points))
+        return polygons
 
+    def _save_polygons(self, polygons):
         # Create a MultiPolygon from all the polygons
         self.multi_polygon = MultiPolygon(polygons)
 
         # Save the data and return the MultiPolygon
-        self.save(self.multi_polygon, 'polygon.pkl', data_file=True)
-        # print(f"The main polygon data has been saved to {self.save_data_path}polygon.pkl.")
+        self.save_geometries(self.multi_polygon, 'polygon')
         return self.multi_polygon
     
     def get_polygon_tiles(self):
@@ -156,23 +229,13 @@ class SVGToPolygon(DataProcessorBaseClass):
             The list of tile indices.
         """
 
-        # TODO : get polygons from polygon.pkl and move this method (and private associated methods) to EnfusionUtils
-        
         # Get the tile indices for each polygon
         if self.multi_polygon is None:
             print("Error: self.multi_polygon is None. You need to generate the polygon first by calling the process() method.")
             return
-        tile_indices = set()
-
-        # Iterate over the tiles in the bounding box of the MultiPolygon
-        minx, miny, maxx, maxy = self.multi_polygon.bounds
-        for x in range(int(minx), int(maxx) + 1, self.tile_step):
-            for y in range(int(miny), int(maxy) + 1, self.tile_step):
-                point = Point(x, y)
-                if self.multi_polygon.contains(point):
-                    tile_index = self._get_tile_index(x, y)
-                    tile_indices.add(tile_index)
-        tile_indices = sorted(list(tile_indices))
+
+        # Intersect the MultiPolygon with the tile grid in one batch
+        tile_indices = self.enfusion_utils.get_geometry_tiles(self.multi_polygon)
                 
         # Save the tile indices to a file
         with open(self.save_path + "polygon_tiles.txt", 'w') as file:
@@ -182,26 +245,3 @@ class SVGToPolygon(DataProcessorBaseClass):
         
         print(f"{len(tile_indices)} tiles could be changed after importing masks in Enfusion.\nFor the list of tile indices, see {self.save_path + "polygon_tiles.txt"}")
         return tile_indices
-   
-    def _get_tile_index(self, x, y):
-        """
-        Gets the tile index for a given point.
-
-        Parameters
-        ----------
-        x : int
-            The x-coordinate of the point.
-        y : int
-            The y-coordinate of the point.
-
-        Returns
-        -------
-        int
-            The tile index.
-        """
-        tile_x = x // self.tile_size
-        tile_y = y // self.tile_size
-        tile_index = int(tile_y * self.num_x_tiles + tile_x)
-        return tile_index
-
-
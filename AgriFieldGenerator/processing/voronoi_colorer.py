@@ -12,10 +12,9 @@
 # The Enfusion Workbench is a creation workbench dedicated to the Enfusion engine.
 # 
 
-from random import choice, uniform
 
-import matplotlib.pyplot as plt
-import networkx as nx
+import numpy as np
+import shapely
 from shapely.geometry import Polygon, MultiPolygon
 from shapely.ops import unary_union
 from shapely.geometry import Polygon as ShapelyPolygon
@@ -59,6 +58,8 @@ class VoronoiColorer(DataProcessorBaseClass):
         The minimum border width.
     max_border_width : float
         The maximum border width.
+    preview : bool
+        Whether to render the colored diagram to preview.png.
     colored_polygons : list
         A list of ColoredPolygon objects.
     """
@@ -73,7 +74,15 @@ class VoronoiColorer(DataProcessorBaseClass):
                 svg_width,
                 palette,
                 min_border_width,
-                max_border_width):
+                max_border_width,
+                preview=True,
+                artifact_format='columnar',
+                polygon=None,
+                points=None,
+                voronoi=None,
+                adjacency=None,
+                checkpoint=True,
+                seed=None):
         """
         Constructs all the necessary attributes for the VoronoiColorer object.
 
@@ -95,8 +104,23 @@ class VoronoiColorer(DataProcessorBaseClass):
             The minimum border width.
         max_border_width : float
             The maximum border width.
+        preview : bool, optional
+            Whether to render the colored diagram to preview.png (default is True).
+            The preview is only needed by the 'preview' mask engine.
+        artifact_format : str, optional
+            The format of the saved colored polygons, 'columnar' or 'pickle' (default is 'columnar').
+        polygon, points, voronoi : optional
+            The main polygon, the seed points and the Voronoi polygons, if they are already in memory.
+            Otherwise, they are loaded from the data directory.
+        adjacency : list, optional
+            The adjacency list of the Voronoi polygons, if it is already in memory. Otherwise, it is loaded
+            from the data directory if the VoronoiFiller saved it, or rebuilt from the polygons.
+        checkpoint : bool, optional
+            Whether to save the colored polygons to the data directory (default is True).
+        seed : int or numpy.random.SeedSequence, optional
+            The seed of the random border widths and colors (default is None, for a different result at each run).
         """
-        super().__init__(source_path=source_path, save_path=save_path, save_data_path=save_data_path, svg_path=svg_path, svg_height=svg_height, svg_width=svg_width)
+        super().__init__(source_path=source_path, save_path=save_path, save_data_path=save_data_path, svg_path=svg_path, svg_height=svg_height, svg_width=svg_width, artifact_format=artifact_format, checkpoint=checkpoint, seed=seed)
         self.project_name = project_name
         self.source_path = source_path
         self.save_path = save_path
@@ -104,15 +128,28 @@ class VoronoiColorer(DataProcessorBaseClass):
         self.palette = palette
         self.min_border_width = min_border_width
         self.max_border_width = max_border_width
+        self.preview = preview
         self.colored_polygons = None
+        self.adjacency = adjacency
 
+        # Load needed data, unless it has been passed in memory
+        self.polygon = polygon
+        self.points = points
+        self.intersection_polygons = voronoi
         try:
-            # Load needed data
-            self.polygon = self.load('polygon.pkl', data_file=True)
-            self.points = self.load('points.pkl', data_file=True)
-            self.intersection_polygons = self.load('voronoi.pkl', data_file=True)
+            if self.polygon is None:
+                self.polygon = self.load_geometries('polygon')
+            if self.points is None:
+                self.points = self.load_points()
+            if self.intersection_polygons is None:
+                self.intersection_polygons = self.load_geometries('voronoi')
         except FileNotFoundError:
             raise FileNotFoundError("Polygon, points or Voronoi diagram data are missing. Please run the SvgToPolygon, PointsGenerator and VoronoiFiller classes first!")
+        if self.adjacency is None:
+            try:
+                self.adjacency = self.load_adjacency()
+            except FileNotFoundError:
+                pass
     
     def process(self):
         """
@@ -124,6 +161,8 @@ class VoronoiColorer(DataProcessorBaseClass):
             A list of ColoredPolygon objects.
         """
 
+        import networkx as nx
+
         description = "Coloring diagram"
         description += " " * (26 - len(description))
         pbar = tqdm(total=9, desc=description, unit=" step(s)")
@@ -136,15 +175,14 @@ class VoronoiColorer(DataProcessorBaseClass):
         pbar.update(1)
         
         # Add nodes to the graph
-        for i, poly in enumerate(self.intersection_polygons):
-            G.add_node(i)
+        G.add_nodes_from(range(len(self.intersection_polygons)))
         pbar.update(1)
 
-        # Add edges to the graph
-        for i, poly1 in enumerate(self.intersection_polygons):
-            for j, poly2 in enumerate(self.intersection_polygons):
-                if i != j and poly1.touches(poly2):
-                    G.add_edge(i, j)
+        # Add edges to the graph. The adjacency comes with the Voronoi diagram, unless it does not match the polygons
+        if self.adjacency is None or len(self.adjacency) != len(self.intersection_polygons):
+            self.adjacency = self._build_adjacency()
+            self.save_adjacency(self.adjacency)
+        G.add_edges_from((i, j) for i, neighbours in enumerate(self.adjacency) for j in neighbours if i < j)
 
         pbar.update(1)
         # Color the graph
@@ -161,14 +199,14 @@ class VoronoiColorer(DataProcessorBaseClass):
             if isinstance(poly, Polygon):
                 x, y = poly.exterior.xy
                 # Set border width as a fraction of the minimum distance to another polygon
-                border_width = uniform(self.min_border_width, self.max_border_width) if self.max_border_width > self.min_border_width else self.min_border_width
+                border_width = float(self.rng.uniform(self.min_border_width, self.max_border_width)) if self.max_border_width > self.min_border_width else self.min_border_width
                 colored_polygon = ColoredPolygon(zip(x, y), color=color, border_width=border_width)
                 self.colored_polygons.append(colored_polygon)  # Add the colored polygon to the list
                               
             elif isinstance(poly, MultiPolygon):
                 for sub_poly in poly.geoms:
                     x, y = sub_poly.exterior.xy
-                    border_width = uniform(self.min_border_width, self.max_border_width) if self.max_border_width > self.min_border_width else self.min_border_width
+                    border_width = float(self.rng.uniform(self.min_border_width, self.max_border_width)) if self.max_border_width > self.min_border_width else self.min_border_width
                     colored_polygon = ColoredPolygon(zip(x, y), color=color, border_width=border_width)
                     self.colored_polygons.append(colored_polygon)  # Add the colored polygon to the list
 
@@ -192,25 +230,67 @@ class VoronoiColorer(DataProcessorBaseClass):
         pbar.update(1)
         # Color each non-colored area with a random color from the palette
         for area in non_colored_area:
-            color = choice(palette)
+            color = palette[self.rng.integers(len(palette))]
             x, y = area.exterior.xy
             if self.max_border_width > self.min_border_width:
-                border_width = uniform(self.min_border_width, self.max_border_width)
+                border_width = float(self.rng.uniform(self.min_border_width, self.max_border_width))
             colored_polygon = ColoredPolygon(zip(x, y), color=color, border_width=border_width)
             # Add the colored polygon to self.colored_polygons
             self.colored_polygons.append(colored_polygon)    
 
         pbar.update(1)
         # Save the data and return the colored polygons
-        self.save(self.colored_polygons, 'colored.pkl', data_file=True)
+        self.save_geometries(self.colored_polygons, 'colored')
         # Save the result as an image
-        fig, ax = self.display(show=False)
-        fig = plt.gcf()
-        self.save(fig, 'preview.png', dpi=100)
+        if self.preview:
+            fig, ax = self.display(show=False)
+            fig = self._pyplot().gcf()
+            self.save(fig, 'preview.png', dpi=100)
 
         pbar.close()
         return self.colored_polygons
-        
+
+    def _build_adjacency(self, min_shared_length=0.0):
+        """
+        Builds the adjacency list of the Voronoi polygons.
+
+        Candidate pairs are found with a single bulk query on a STRtree of the
+        prepared polygons, so only polygons whose envelopes overlap are tested.
+        Each candidate pair is kept only if the two polygons share a border
+        longer than `min_shared_length`: polygons meeting at a single corner are
+        not neighbours.
+
+        Parameters
+        ----------
+        min_shared_length : float, optional
+            The minimum length of the shared border (default is 0.0).
+
+        Returns
+        -------
+        list
+            For each polygon of intersection_polygons, the sorted list of the
+            indices of its neighbours.
+        """
+        geometries = np.empty(len(self.intersection_polygons), dtype=object)
+        geometries[:] = self.intersection_polygons
+        shapely.prepare(geometries)
+
+        # Bulk query: every pair whose geometries intersect, each pair tested once
+        tree = shapely.STRtree(geometries)
+        left, right = tree.query(geometries, predicate='intersects')
+        once = left < right
+        left, right = left[once], right[once]
+
+        # Keep the pairs that share a border, not only a corner
+        shared_length = shapely.length(shapely.intersection(geometries[left], geometries[right]))
+        shared = shared_length > min_shared_length
+        left, right = left[shared], right[shared]
+
+        adjacency = [[] for _ in range(len(geometries))]
+        for i, j in zip(np.concatenate([left, right]).tolist(), np.concatenate([right, left]).tolist()):
+            adjacency[i].append(j)
+        return [sorted(neighbours) for neighbours in adjacency]
+
     def display(self, display_point=False, display_voronoi=False, show=True):
         """
         Displays the colored Voronoi diagram.
@@ -230,6 +310,8 @@ class VoronoiColorer(DataProcessorBaseClass):
             A tuple containing the figure and axes objects.
         """
             
+        plt = self._pyplot(interactive=show)
+
         # Fermer les figures existantes
         plt.close('all')
         
@@ -252,8 +334,7 @@ class VoronoiColorer(DataProcessorBaseClass):
         
         if display_point:
             # Display points          
-            for point in self.points:
-                ax.plot(*point, 'ko', markersize=1)
+            ax.plot(self.points[:, 0], self.points[:, 1], 'ko', markersize=1)
             
         if display_voronoi:
             for polygon in self.intersection_polygons:
@@ -14,14 +14,13 @@
 
 import os
 import glob
-import random
 
 import numpy as np
-from scipy.spatial import Voronoi
-from shapely.geometry import LineString, Point, Polygon, MultiPolygon
-from shapely.ops import linemerge
+import shapely
+from shapely.geometry import Polygon, MultiPolygon
 from tqdm import tqdm
 
+from .bezier import evaluate_bezier
 from .data_processor_base_class import DataProcessorBaseClass
 
 class VoronoiFiller(DataProcessorBaseClass):
@@ -31,7 +30,8 @@ class VoronoiFiller(DataProcessorBaseClass):
     Attributes
     ----------
     All the attributes from DataProcessorBaseClass and the following. All values
-    are read from the configuration file, except intersection_polygons.
+    are read from the configuration file, except intersection_polygons, tessellation
+    and adjacency.
 
     svg_height : int
         The height of the SVG.
@@ -39,6 +39,10 @@ class VoronoiFiller(DataProcessorBaseClass):
         The width of the SVG.
     intersection_polygons : list
         The list of polygons resulting from the intersection of the Voronoi diagram and the input polygon.
+    tessellation : VoronoiTessellation
+        The cells of the Voronoi diagram and the edges they share.
+    adjacency : list
+        For each polygon of intersection_polygons, the sorted list of the indices of its neighbours.
 
     Methods
     -------
@@ -47,36 +51,49 @@ class VoronoiFiller(DataProcessorBaseClass):
     display(display_points=False):
         Displays the input polygon, the generated points, and the Voronoi diagram.
     """
+    # The quantization step used to match the vertices and the edges shared by two polygons
+    EDGE_QUANTUM = 1e-6
+
     def __init__(self,
                 source_path,
                 save_path,
                 save_data_path,
                 svg_path,
                 svg_height,
-                svg_width):
-        super().__init__(source_path=source_path, save_path=save_path, save_data_path=save_data_path, svg_path=svg_path, svg_height=svg_height, svg_width=svg_width)
+                svg_width,
+                artifact_format='columnar',
+                polygon=None,
+                points=None,
+                voronoi=None,
+                checkpoint=True,
+                seed=None):
+        super().__init__(source_path=source_path, save_path=save_path, save_data_path=save_data_path, svg_path=svg_path, svg_height=svg_height, svg_width=svg_width, artifact_format=artifact_format, checkpoint=checkpoint, seed=seed)
         self.source_path = source_path
         self.save_path = save_path
         self.save_data_path = save_data_path
-        self.intersection_polygons = None
-        self.curved_edges = {}
+        self.intersection_polygons = voronoi
         self.curved_polygons = []
-        self.cleaned_polygons = []
+        self.tessellation = None
+        self.adjacency = None
 
         # we generate a new set of colored polygons, so we need to delete subsequant files
         glob.glob(self.save_path + '*.png')
 
-        # Load needed data
+        # Load needed data, unless it has been passed in memory
+        self.polygon = polygon
+        self.points = points
         try:
-            self.polygon = self.load('polygon.pkl', data_file=True)
-            self.points = self.load('points.pkl', data_file=True)
+            if self.polygon is None:
+                self.polygon = self.load_geometries('polygon')
+            if self.points is None:
+                self.points = self.load_points()
         except FileNotFoundError:
             raise FileNotFoundError("Polygon or points data are missing. Please run the SVGToPolygon and PointsGenerator classes first!")
         
     def process(self):
         """
         Generates the Voronoi diagram from the points within the polygon and intersects it with the input polygon. 
-        The resulting polygons are saved in the 'voronoi.pkl' file.
+        The resulting polygons are saved as the 'voronoi' geometry artifact.
 
         Returns
         -------
@@ -84,37 +101,28 @@ class VoronoiFiller(DataProcessorBaseClass):
             A list of polygons resulting from the intersection of the Voronoi diagram and the input polygon.
         """     
 
-        # We generate a new voronoi diagram, so we need to delete colored.pkl
-        if os.path.exists(self.save_data_path + 'colored.pkl'):
-            os.remove(self.save_data_path + 'colored.pkl')
-        pbar = tqdm(total=7, desc="Generating Voronoi diagram", unit=" step")
-        # Convert points to a 2-D array
-        points_array = np.array(self.points)
-        pbar.update(1)
-        
-        # Create the Voronoi diagram
-        vor = Voronoi(points_array)
-        pbar.update(1)
-        
-        # Create polygons for each Voronoi region
-        voronoi_polygons = [Polygon(vor.vertices[region]) for region in vor.regions if -1 not in region and len(region) > 0]
-        pbar.update(1)
-        
-        # Intersect the Voronoi polygons with the input polygon
-        self.intersection_polygons = [poly.intersection(self.polygon) for poly in voronoi_polygons]
+        # We generate a new voronoi diagram, so we need to delete the colored polygons and adjacency.pkl
+        self.remove_geometries('colored')
+        if os.path.exists(self.save_data_path + 'adjacency.pkl'):
+            os.remove(self.save_data_path + 'adjacency.pkl')
+        from .voronoi_tessellation import VoronoiTessellation
+
+        pbar = tqdm(total=4, desc="Generating Voronoi diagram", unit=" step")
+        # Create the Voronoi diagram, with the edges shared by its cells
+        self.tessellation = VoronoiTessellation(self.points)
         pbar.update(1)
         
-        # Clean up the polygons before finding the intersection
+        # Clean up the input polygon before finding the intersection
         cleaned_polygon = self.polygon.buffer(0)
-        cleaned_voronoi_polygons = [Polygon(poly.buffer(0).exterior) for poly in voronoi_polygons]
         pbar.update(1)
         
-        # Remove empty polygons
-        self.intersection_polygons = [poly.intersection(cleaned_polygon) for poly in cleaned_voronoi_polygons]
+        # Intersect the Voronoi cells with the input polygon, empty cells are removed
+        self.intersection_polygons, _, self.adjacency = self.tessellation.clip(cleaned_polygon)
         pbar.update(1)
         
         # Save the data and return the voronoi polygons
-        self.save(self.intersection_polygons, 'voronoi.pkl', data_file=True)
+        self.save_geometries(self.intersection_polygons, 'voronoi')
+        self.save_adjacency(self.adjacency)
         pbar.update(1)
         pbar.close()
         print(f"Number of generated polygons: {len(self.intersection_polygons)}")
@@ -146,151 +154,228 @@ class VoronoiFiller(DataProcessorBaseClass):
 
         self.intersection_polygons = non_triangle_polygons
         # Save the data and return the voronoi polygons
-        self.save(self.intersection_polygons, 'voronoi.pkl', data_file=True)
+        self.save_geometries(self.intersection_polygons, 'voronoi')
         return self.intersection_polygons
 
-    def pp_curve_voronoi_edges(self, curve_probability=0.4):
+    def pp_curve_voronoi_edges(self, curve_probability=0.4, sample_spacing=2.0):
+        """
+        Post-processes the Voronoi diagram by curving some of its borders, inside the main polygon.
+
+        Parameters
+        ----------
+        curve_probability : float, optional
+            The probability to curve a border (default is 0.4).
+        sample_spacing : float, optional
+            The approximate distance between two points of a curved border (default is 2.0). The number of
+            points of a curve is derived from the length of the border, between 8 and 100.
+
+        Returns
+        -------
+        list
+            The curved polygons.
+        """
+        # Curve the diagram generated by process() if any, otherwise the saved one
+        voronoi_polygons = self.intersection_polygons
         try:
-            voronoi_polygons = self.load('voronoi.pkl', data_file=True)
+            if voronoi_polygons is None:
+                voronoi_polygons = self.load_geometries('voronoi')
         except FileNotFoundError:
             raise FileNotFoundError("Voronoi data is missing. Please run the process method of VoronoiFiller class first!")
         
-        curved_polygons = []
-        
+        polygons = []
         for polygon in voronoi_polygons:
             if isinstance(polygon, MultiPolygon):
-                for poly in polygon.geoms:
-                    curved_polygons.append(self._curve_polygon_edges_random(poly, curve_probability))
+                polygons.extend(polygon.geoms)
             else:
-                curved_polygons.append(self._curve_polygon_edges_random(polygon, curve_probability))
-        self.curved_polygons = curved_polygons
-        curved_polygons = self._clean_edges()
-        # tranform the list of LineString to polygons
-        polygon_objects = [Polygon(linemerge([line_string for line_string in sublist]).coords) for sublist in curved_polygons]
+                polygons.append(polygon)
+        self.curved_polygons = self._curve_edges_random(polygons, curve_probability, sample_spacing)
+        print(f"Number of polygons after curving borders: {len(self.curved_polygons)}")
         # Save the data and return the voronoi polygons
-        self.curved_polygons = polygon_objects
-        self.save(self.curved_polygons, 'voronoi.pkl', data_file=True)
+        self.save_geometries(self.curved_polygons, 'voronoi')
+        self.save_adjacency(self.adjacency)
         return self.curved_polygons
 
-    def _curve_polygon_edges_random(self, polygon, curve_probability):
-        curved_polygon_edges = []
-        num_vertices = len(polygon.exterior.coords) - 1
-        index_point = 1
-        # Iterate over the edges of the polygon
-        for i in range(num_vertices):
-            if self.polygon.intersects(Point(polygon.exterior.coords[i])):
-                start_point, end_point = polygon.exterior.coords[i], polygon.exterior.coords[i+1]
-                old_edge = LineString([start_point, end_point])
-                if random.uniform(0, 1) < curve_probability:  # the edge is a line, curve it with a certain probability
-                    control_points = self._generate_control_points(start_point, end_point, 10)
-                    new_edge = self._generate_pseudo_curve(start_point, control_points, end_point)
-                else:  # the edge is a line and we don't curve it
-                    new_edge = old_edge
-            # Add the new edge to the resulting polygon
-            else:
-                if i < num_vertices:
-                    new_edge = LineString(polygon.exterior.coords[i:i+2])
-                else:
-                    new_edge = LineString([polygon.exterior.coords[i], polygon.exterior.coords[0]])   
-            curved_polygon_edges.append(new_edge)
-            index_point += 1
-        return curved_polygon_edges
-        # return Polygon(curved_polygon_points)  
-       
-    def _generate_control_points(self, start_point, end_point, num_points, min_spacing=0.1, max_offset=0.1):
-        points = []
-        segment_length = np.linalg.norm(np.array(end_point) - np.array(start_point))
-        min_spacing = min_spacing * segment_length
-        max_offset = max_offset * segment_length
-        positions = np.linspace(0.25, 0.75, num_points + 2)[1:-1]  # exclude the ends
-        for t in positions:
-            offset = np.random.uniform(-max_offset, max_offset)
-            point = (1 - t) * np.array(start_point) + t * np.array(end_point) + offset
-            if points and np.linalg.norm(point - points[-1]) < min_spacing:
-                continue  # skip this point if it's too close to the previous one
-            points.append(point)
-        return points
-    
-    def _generate_pseudo_curve(self, start_point, control_points, end_point):
-        # Combine all points
-        points = [start_point] + control_points + [end_point]
-        
-        def de_casteljau(t, points):
-            if len(points) == 1:
-                return points[0]           
-            new_points = []
-            for i in range(len(points) - 1):
-                x = (1 - t) * points[i][0] + t * points[i + 1][0]
-                y = (1 - t) * points[i][1] + t * points[i + 1][1]
-                new_points.append((x, y))
-            return de_casteljau(t, new_points)
-        
-        # Generate curve points
-        curve_points = [de_casteljau(t, points) for t in np.linspace(0.0, 1.0, 100)]
-        return LineString(curve_points)
-    
-    def _find_adjacent_polygon(self, poly_collection, original_polygon, original_edge_vertices):
+    def _build_edge_index(self, starts, ends, quantum):
         """
-        Find the polygon in the collection that shares the edge with the original polygon.
+        Indexes the edges of the polygons by their end points, so that an edge shared by two polygons gets
+        the same index in both.
+
+        The end points are quantized to `quantum`, and each edge is keyed by its two end points in
+        lexicographic order, so that the key does not depend on the direction in which a polygon runs
+        along the edge. The index is built in a single pass over the edges.
 
-        param poly_collection: a collection of polygons
-        param original_polygon: the original polygon
-        param original_edge_vertices: the edge vertices of the original polygon
-        return: the adjacent polygon if found, None otherwise
+        Parameters
+        ----------
+        starts, ends : numpy.ndarray
+            The (E, 2) arrays of the start and end points of the edges.
+        quantum : float
+            The quantization step of the coordinates.
 
-        TODO: accept more types of polygon collections. Now it only accepts a list of polygons.
+        Returns
+        -------
+        tuple
+            The (E,) array of the edge indices, and the (E,) mask of the edges that run in the opposite
+            direction to their key.
         """
-        for polygon in poly_collection:
-            if polygon == original_polygon:
-                continue
-            else:
-                for edge in list(polygon):
-                    edge_vertices = LineString([edge.coords[0], edge.coords[len(edge.coords) - 1]])
-                    if edge_vertices == original_edge_vertices or edge_vertices == LineString([original_edge_vertices.coords[1], original_edge_vertices.coords[0]]):
-                        return polygon
-        return None
-    
-    def _replace_edge(self, polygon, new_edge):
+        start_keys = np.round(starts / quantum).astype(np.int64)
+        end_keys = np.round(ends / quantum).astype(np.int64)
+        reversed_edges = (start_keys[:, 0] > end_keys[:, 0]) | ((start_keys[:, 0] == end_keys[:, 0]) & (start_keys[:, 1] > end_keys[:, 1]))
+        keys = np.where(reversed_edges[:, None], np.concatenate([end_keys, start_keys], axis=1), np.concatenate([start_keys, end_keys], axis=1))
+
+        edge_index = {}
+        edge_ids = np.fromiter((edge_index.setdefault(key, len(edge_index)) for key in map(tuple, keys.tolist())), dtype=np.int64, count=len(keys))
+        return edge_ids, reversed_edges
+
+    def _curve_edges_random(self, polygons, curve_probability, sample_spacing):
         """
-        Replace the old edge with the new edge in the polygon.
+        Curves the edges that start inside the main polygon with a given probability, and rebuilds the polygons.
+
+        Each edge shared by two polygons is curved only once, and the same curve is written into both of them,
+        reversed for the polygon that runs along the edge in the other direction, so that the two sides of a
+        border are always identical. All the edges of all the polygons are processed in one batch. The curves
+        of a polygon that would cross its other borders are straightened again.
+
+        The adjacency list of the curved polygons is set as well: two polygons are neighbours if they share an edge.
+
+        Returns
+        -------
+        list
+            The curved polygons. Degenerate polygons, with less than 3 edges, are dropped.
         """
-        new_edge_vertices = LineString([new_edge.coords[0], new_edge.coords[len(new_edge.coords) - 1]])
-        new_edge_vertices_inv = LineString([new_edge.coords[len(new_edge.coords) - 1], new_edge.coords[0]])
-        for i, edge in zip(range(len(polygon)), list(polygon)):
-            edge_vertices = LineString([edge.coords[0], edge.coords[len(edge.coords) - 1]])
-            if edge_vertices == new_edge_vertices or edge_vertices == new_edge_vertices_inv:
-                polygon[i] = new_edge
-                return polygon
-        return None
-
-    def _clean_edges(self):   
-        
-        description = "Cleaning borders"
-        description += " " * (26 - len(description))
-        
-        for curved_poly in tqdm(list(self.curved_polygons), desc=description, unit=" polygon(s)"):
-            for edge in list(curved_poly):
-                if len(edge.coords) > 2:
-                    # If the edge is a curve
-                    edge_vertices = LineString([edge.coords[0], edge.coords[len(edge.coords) - 1]])
-                    # We look for an adjacent polygon that shares the same edge in the cleaned_polygons list
-                    adjacent_polygon = self._find_adjacent_polygon(self.cleaned_polygons, curved_poly, edge_vertices)
-                    if adjacent_polygon is not None:
-                        # If an adjacent polygon is found,
-                        # We check if this polygon has already been updated (exists in cleaned_polygons)
-                        new_polygon = self._replace_edge(adjacent_polygon, edge)
-                        self.cleaned_polygons.remove(adjacent_polygon)
-                        self.cleaned_polygons.append(new_polygon)
-                    else:
-                        # We look for an adjacent polygon in the curved_polygons list
-                        adjacent_polygon = self._find_adjacent_polygon(self.curved_polygons, curved_poly, edge_vertices)
-                        if adjacent_polygon is not None:
-                            new_polygon = self._replace_edge(adjacent_polygon, edge)
-                            self.cleaned_polygons.append(curved_poly)
-                        else:
-                            self.cleaned_polygons.append(curved_poly)
-                else:
-                    self.cleaned_polygons.append(curved_poly)
-        print(f"Number of polygons after curving and cleaning borders: {len(self.curved_polygons)}")
-        return self.cleaned_polygons
+        rings = [np.asarray(polygon.exterior.coords) for polygon in polygons if not polygon.is_empty]
+        rings = [ring for ring in rings if len(ring) > 3]
+        self.adjacency = []
+        if not rings:
+            return []
+        counts = np.array([len(ring) - 1 for ring in rings])
+        vertices = np.concatenate([ring[:-1] for ring in rings])
+        # Snap the vertices that are equal once quantized to the same coordinates, so that the polygons sharing
+        # a vertex agree on it exactly
+        vertex_keys = np.round(vertices / self.EDGE_QUANTUM).astype(np.int64)
+        _, first_vertices, vertex_ids = np.unique(vertex_keys, axis=0, return_index=True, return_inverse=True)
+        vertices = vertices[first_vertices[vertex_ids.ravel()]]
+        polygon_ids = np.repeat(np.arange(len(rings)), counts)
+        # The end of an edge is the next vertex of its ring
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        next_vertices = np.arange(len(vertices)) + 1
+        next_vertices[offsets + counts - 1] = offsets
+        starts, ends = vertices, vertices[next_vertices]
+
+        edge_ids, reversed_edges = self._build_edge_index(starts, ends, self.EDGE_QUANTUM)
+        num_edges = edge_ids.max() + 1
+        # Each edge is stored once, in the direction of its key, from its first occurrence
+        first = np.full(num_edges, len(edge_ids))
+        np.minimum.at(first, edge_ids, np.arange(len(edge_ids)))
+        edge_starts = np.where(reversed_edges[:, None], ends, starts)[first]
+        edge_ends = np.where(reversed_edges[:, None], starts, ends)[first]
+
+        # The occurrences of the same edge are consecutive once sorted, a zero-length edge is only a common corner
+        order = np.argsort(edge_ids, kind='stable')
+        shared = (edge_ids[order[1:]] == edge_ids[order[:-1]]) & (edge_starts != edge_ends).any(axis=1)[edge_ids[order[1:]]]
+        left, right = polygon_ids[order[:-1]][shared], polygon_ids[order[1:]][shared]
+        neighbours = [set() for _ in rings]
+        for i, j in zip(left.tolist(), right.tolist()):
+            if i != j:
+                neighbours[i].add(j)
+                neighbours[j].add(i)
+        self.adjacency = [sorted(polygon_neighbours) for polygon_neighbours in neighbours]
+
+        # Test all the edge start points against the main polygon at once
+        shapely.prepare(self.polygon)
+        inside = shapely.intersects_xy(self.polygon, edge_starts[:, 0], edge_starts[:, 1])
+        # The edges are drawn by chunks, each one from its own generator, so that the curves do not depend on
+        # how the edges are split between workers
+        curved = np.zeros(num_edges, dtype=bool)
+        random_offsets = []
+        for start, stop, rng in self.chunk_generators(num_edges):
+            curved[start:stop] = inside[start:stop] & (rng.uniform(0, 1, stop - start) < curve_probability)
+            random_offsets.append(rng.uniform(-1, 1, (np.count_nonzero(curved[start:stop]), 10)))
+
+        # The points of each edge, without its end point, which is the start point of the next edge of the ring
+        edge_points = [points[None, :] for points in edge_starts]
+        if curved.any():
+            control_points, accepted = self._generate_control_points(edge_starts[curved], edge_ends[curved], np.concatenate(random_offsets))
+            curves = self._generate_pseudo_curves(edge_starts[curved], edge_ends[curved], control_points, accepted, sample_spacing)
+            for edge_id, points in zip(np.flatnonzero(curved), curves):
+                edge_points[edge_id] = points
+
+        while True:
+            ring_points = []
+            for edge_id, is_reversed in zip(edge_ids.tolist(), reversed_edges.tolist()):
+                points = edge_points[edge_id]
+                if is_reversed:
+                    # Run along the edge from its other end, which is the start point of this occurrence
+                    points = np.concatenate([edge_ends[edge_id][None, :], points[:0:-1]])
+                ring_points.append(points)
+            lengths = np.fromiter((len(points) for points in ring_points), dtype=np.int64, count=len(ring_points))
+            coords = np.concatenate(ring_points)
+            curved_polygons = shapely.polygons(shapely.linearrings(coords, indices=np.repeat(polygon_ids, lengths)))
+
+            # A curve can cross another border of its polygon: straighten the curves of the invalid polygons
+            invalid = ~shapely.is_valid(curved_polygons)
+            invalid_edges = np.unique(edge_ids[invalid[polygon_ids]])
+            invalid_edges = invalid_edges[curved[invalid_edges]]
+            if len(invalid_edges) == 0:
+                return list(curved_polygons)
+            curved[invalid_edges] = False
+            for edge_id in invalid_edges.tolist():
+                edge_points[edge_id] = edge_starts[edge_id][None, :]
+
+    def _generate_control_points(self, start_points, end_points, random_offsets, min_spacing=0.1, max_offset=0.1):
+        """
+        Generates the control points of a batch of curves. The candidates are spread along the middle half
+        of each edge and shifted by a random offset, and a candidate is dropped if it is too close to the
+        previous control point of its curve. The (M, num_points) random offsets, between -1 and 1, are
+        scaled by max_offset times the length of the edge.
+
+        Returns
+        -------
+        tuple
+            The (M, num_points, 2) array of candidates, and the (M, num_points) mask of the kept ones.
+        """
+        segment_lengths = np.linalg.norm(end_points - start_points, axis=1)
+        min_spacing = min_spacing * segment_lengths
+        max_offset = max_offset * segment_lengths
+        num_points = random_offsets.shape[1]
+        positions = np.linspace(0.25, 0.75, num_points + 2)[1:-1]  # exclude the ends
+        offsets = random_offsets * max_offset[:, None]
+        candidates = ((1 - positions)[None, :, None] * start_points[:, None, :]
+                      + positions[None, :, None] * end_points[:, None, :]
+                      + offsets[:, :, None])
+
+        # The spacing test depends on the previous kept point, so it runs along the candidates, for all the curves at once
+        accepted = np.zeros((len(start_points), num_points), dtype=bool)
+        accepted[:, 0] = True
+        previous = candidates[:, 0]
+        for i in range(1, num_points):
+            keep = np.linalg.norm(candidates[:, i] - previous, axis=1) >= min_spacing
+            accepted[:, i] = keep
+            previous = np.where(keep[:, None], candidates[:, i], previous)
+        return candidates, accepted
+
+    def _generate_pseudo_curves(self, start_points, end_points, control_points, accepted, sample_spacing):
+        """
+        Evaluates a batch of Bezier curves from their end points and their kept control points. Curves of the
+        same degree and number of samples are evaluated together through their Bernstein basis matrix.
+
+        Returns
+        -------
+        numpy.ndarray
+            The array of the points of the curves, each one a (N, 2) array that starts with the start point and
+            stops before the end point.
+        """
+        degrees = accepted.sum(axis=1) + 1
+        segment_lengths = np.linalg.norm(end_points - start_points, axis=1)
+        num_samples = np.clip(np.ceil(segment_lengths / sample_spacing).astype(int) + 1, 8, 100)
 
+        curves = np.empty(len(start_points), dtype=object)
+        groups = np.unique(np.stack([degrees, num_samples], axis=1), axis=0)
+        for degree, samples in groups:
+            indices = np.flatnonzero((degrees == degree) & (num_samples == samples))
+            points = np.empty((len(indices), degree + 1, 2))
+            points[:, 0] = start_points[indices]
+            points[:, 1:-1] = control_points[indices][accepted[indices]].reshape(len(indices), degree - 1, 2)
+            points[:, -1] = end_points[indices]
+            for index, curve in zip(indices, evaluate_bezier(points, samples)[:, :-1]):
+                curves[index] = curve
+        return curves
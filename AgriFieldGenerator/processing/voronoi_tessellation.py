@@ -0,0 +1,198 @@
+# Copyright (c) [2024] [Didier ALAIN]
+# Repository: https://github.com/Tanin69/AgriFieldGenerator
+#
+# The project makes it possible to generate patterns of large cultivated fields
+# reproducing as believable as possible the diversity of agricultural
+# landscapes. It allows you to generate texture masks that can be used in the
+# world editor of the Enfusion Workbench.
+#
+# It is released under the MIT License. Please see the LICENSE file for details.
+#
+# Enfusion is a game engine developed by Bohemia Interactive for the Arma game series
+# The Enfusion Workbench is a creation workbench dedicated to the Enfusion engine.
+#
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import shapely
+
+class VoronoiTessellation:
+    """
+    A class used to represent the topology of a Voronoi diagram: its cells, the
+    edges they share and which cells are neighbours, as integer arrays.
+
+    It is built from the ridges computed by Qhull, so that the edges shared by
+    two cells do not have to be found again geometrically. There is one cell per
+    seed point, and the cells of the points on the convex hull, which are
+    unbounded, are marked as not finite.
+
+    Variable-length lists are stored in CSR form: the items of the cell i are
+    `items[indptr[i]:indptr[i + 1]]`.
+
+    Attributes
+    ----------
+    points : numpy.ndarray
+        The (N, 2) array of seed points.
+    vertices : numpy.ndarray
+        The (V, 2) array of the vertices of the diagram.
+    edge_vertices : numpy.ndarray
+        The (E, 2) array of the vertices of each edge, -1 for a vertex at infinity.
+    edge_cells : numpy.ndarray
+        The (E, 2) array of the two cells separated by each edge.
+    cell_vertices_indptr, cell_vertices : numpy.ndarray
+        The vertices of each cell, in ring order.
+    cell_edges_indptr, cell_edges : numpy.ndarray
+        The edges of each cell.
+    finite : numpy.ndarray
+        The (N,) mask of the bounded cells.
+
+    Methods
+    -------
+    cell_polygons(cells)
+        Builds the polygons of some cells.
+    neighbours(edge_mask=None)
+        Gets the neighbours of each cell, in CSR form.
+    clip(polygon, max_workers=None)
+        Clips the finite cells with a polygon.
+    """
+    # Above this number of cells to intersect, they are intersected in chunks of CHUNK_SIZE cells, in parallel
+    PARALLEL_CELLS = 20000
+    CHUNK_SIZE = 5000
+
+    def __init__(self, points):
+        """
+        Computes the Voronoi diagram of a set of points.
+
+        Parameters
+        ----------
+        points : numpy.ndarray
+            The (N, 2) array of seed points.
+        """
+        from scipy.spatial import Voronoi
+
+        self.points = np.asarray(points, dtype=np.float64)
+        vor = Voronoi(self.points)
+        self.vertices = vor.vertices
+        self.edge_vertices = np.asarray(vor.ridge_vertices, dtype=np.int64).reshape(-1, 2)
+        self.edge_cells = np.asarray(vor.ridge_points, dtype=np.int64).reshape(-1, 2)
+
+        # Qhull numbers the regions on its own: reorder them by seed point
+        regions = [vor.regions[region] for region in vor.point_region]
+        self.finite = np.array([len(region) > 0 and -1 not in region for region in regions], dtype=bool)
+        self.cell_vertices_indptr = np.zeros(len(regions) + 1, dtype=np.int64)
+        np.cumsum([len(region) for region in regions], out=self.cell_vertices_indptr[1:])
+        self.cell_vertices = np.fromiter((vertex for region in regions for vertex in region), dtype=np.int64, count=self.cell_vertices_indptr[-1])
+
+        # Each edge belongs to the two cells it separates
+        self.cell_edges_indptr, self.cell_edges = self._to_csr(self.edge_cells.ravel(), np.repeat(np.arange(len(self.edge_cells)), 2))
+
+    def cell_polygons(self, cells):
+        """
+        Builds the polygons of some finite cells. Voronoi cells are convex, so the polygons are always valid.
+
+        Parameters
+        ----------
+        cells : numpy.ndarray
+            The indices of the cells.
+
+        Returns
+        -------
+        numpy.ndarray
+            The array of Polygon objects.
+        """
+        cells = np.asarray(cells, dtype=np.int64)
+        starts = self.cell_vertices_indptr[cells]
+        counts = self.cell_vertices_indptr[cells + 1] - starts
+        vertex_indices = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        rings = shapely.linearrings(self.vertices[self.cell_vertices[vertex_indices]], indices=np.repeat(np.arange(len(cells)), counts))
+        return shapely.polygons(rings)
+
+    def neighbours(self, edge_mask=None):
+        """
+        Gets the neighbours of each cell: the cells it shares an edge with.
+
+        Parameters
+        ----------
+        edge_mask : numpy.ndarray, optional
+            The (E,) mask of the edges to take into account (default is all of them).
+
+        Returns
+        -------
+        tuple
+            The CSR arrays (indptr, neighbours), sorted by cell.
+        """
+        edge_cells = self.edge_cells if edge_mask is None else self.edge_cells[edge_mask]
+        return self._to_csr(edge_cells.ravel(), edge_cells[:, ::-1].ravel())
+
+    def clip(self, polygon, max_workers=None):
+        """
+        Clips the finite cells with a polygon, and drops the ones that are outside of it.
+
+        The polygon is prepared once, and the cells are classified in batch: the cells inside the polygon are
+        kept as they are, the ones outside are dropped, and only the ones crossing its border are intersected
+        with it. When there are very many of them, they are intersected in chunks by a pool of threads, since
+        shapely releases the GIL.
+
+        The edges of the diagram are clipped too, once: two clipped cells are neighbours if their common edge
+        keeps a part of positive length inside the polygon, since the border of the two clipped cells is exactly
+        that part.
+
+        Parameters
+        ----------
+        polygon : shapely.Geometry
+            The clipping polygon. It is prepared in place.
+        max_workers : int, optional
+            The number of threads used to intersect the cells (default is the number of CPUs).
+
+        Returns
+        -------
+        tuple
+            The list of clipped cells (Polygon or MultiPolygon objects), the array of the indices of their
+            seed points, and their adjacency list, indexed like the clipped cells.
+        """
+        cells = np.flatnonzero(self.finite)
+        clipped = self.cell_polygons(cells)
+        shapely.prepare(polygon)
+        inside = shapely.contains_properly(polygon, clipped)
+        boundary = np.flatnonzero(~inside & shapely.intersects(polygon, clipped))
+        clipped[boundary] = self._intersection(clipped[boundary], polygon, max_workers)
+        kept = inside
+        # A cell that only touches the polygon leaves a point or a line
+        kept[boundary] = shapely.area(clipped[boundary]) > 0
+        cells, clipped = cells[kept], clipped[kept]
+
+        # Only the edges between two kept cells can be shared by clipped cells
+        cell_order = np.full(len(self.points), -1, dtype=np.int64)
+        cell_order[cells] = np.arange(len(cells))
+        edge_mask = (cell_order[self.edge_cells] >= 0).all(axis=1) & (self.edge_vertices >= 0).all(axis=1)
+        segments = shapely.linestrings(self.vertices[self.edge_vertices[edge_mask]])
+        shared = shapely.contains_properly(polygon, segments)
+        # Only the edges that cross the border of the polygon need to be clipped
+        crossing = np.flatnonzero(~shared & shapely.intersects(polygon, segments))
+        shared[crossing] = shapely.length(shapely.intersection(segments[crossing], polygon)) > 0
+        edge_mask[edge_mask] = shared
+
+        indptr, neighbours = self.neighbours(edge_mask)
+        adjacency = [sorted(cell_order[neighbours[indptr[cell]:indptr[cell + 1]]].tolist()) for cell in cells]
+        return list(clipped), cells, adjacency
+
+    def _intersection(self, geometries, polygon, max_workers):
+        """
+        Intersects an array of geometries with a polygon, in parallel chunks if there are very many of them.
+        """
+        if len(geometries) <= self.PARALLEL_CELLS:
+            return shapely.intersection(geometries, polygon)
+        chunks = np.array_split(geometries, -(-len(geometries) // self.CHUNK_SIZE))
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+            return np.concatenate(list(executor.map(shapely.intersection, chunks, [polygon] * len(chunks))))
+
+    def _to_csr(self, rows, values):
+        """
+        Groups values by row, in CSR form, with one row per cell.
+        """
+        order = np.argsort(rows, kind='stable')
+        indptr = np.zeros(len(self.points) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self.points)), out=indptr[1:])
+        return indptr, values[order]